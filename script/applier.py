@@ -0,0 +1,471 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+import os
+import errno
+import re
+import stat
+import shutil
+import tempfile
+import threading
+import Queue
+
+# outcomes of working on a single file
+OK = "ok"
+SKIPPED = "skipped"
+ERROR = "error"
+MISSING = "missing"
+EXCLUDED = "excluded"
+
+copy_buffer = 1 << 20
+# copying functions, best first; each copies count bytes from offset in one
+# file descriptor to the current position of another
+kernel_copiers = []
+if hasattr(os, "copy_file_range"):
+    kernel_copiers.append(lambda infd, outfd, offset, count:
+                          os.copy_file_range(infd, outfd, count, offset))
+if hasattr(os, "sendfile"):
+    kernel_copiers.append(lambda infd, outfd, offset, count:
+                          os.sendfile(outfd, infd, offset, count))
+# errors meaning a copier can't handle these files, not that the copy failed
+unsupported_errnos = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                          errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF])
+
+# errors meaning a filesystem won't make hard links
+link_errnos = set([errno.EPERM, errno.EXDEV, errno.EMLINK, errno.ENOSYS,
+                   errno.EOPNOTSUPP, errno.ENOTSUP])
+
+# how much of a file to read when deciding whether to leave it alone
+sniff_size = 8192
+# lines at the top of a file to look for generated_marker in
+marker_lines = 5
+generated_marker = re.compile(r"@generated|DO NOT EDIT|[Aa]uto(?:matically)?"
+                              r"[- ]?[Gg]enerated|[Cc]ode [Gg]enerated by")
+
+# how far past the expected end of a box to look for it, to allow for
+# padding that shifts when the year changes length
+prefix_slack = 256
+# expected length of a line skipped before the box
+line_guess = 128
+
+# a year, or a list or range of them; other numbers, such as a version,
+# have to match
+year_run = re.compile(r"\b\d{4}(?:\s*[-,]\s*\d{4})*\b")
+
+def fingerprint(text):
+    """Reduce text to a form that ignores the year (or a list or range of
+    years) and the padding around it, so that a box rendered in another year
+    still matches."""
+    return " ".join(year_run.sub("0", text).split())
+
+def read_prefix(fp, skip_line, size, data = None):
+    """Read past the first skip_line lines of an open file and return at
+    most size bytes of what follows.  Reads are sized to fetch just that
+    much when the skipped lines are of ordinary length, so on an unbuffered
+    file this usually takes a single read.
+
+    data: what has already been read from the start of the file, if
+      anything, such as by sniff."""
+    return locate_prefix(fp, skip_line, size, data)[1]
+
+def locate_prefix(fp, skip_line, size, data = None):
+    """Like read_prefix, for a file read from its start, but return the
+    offset of the prefix in the file along with it."""
+    start, data = read_head(fp, skip_line, size, data)
+    return start, data[start:start + size]
+
+def read_head(fp, skip_line, size, data = None):
+    """Like locate_prefix, but return everything read from the start of
+    the file, which may run past the prefix, along with its offset."""
+    if data is None:
+        data = fp.read(size + skip_line * line_guess)
+    start = 0
+    for i in range(skip_line):
+        end = data.find("\n", start)
+        while end == -1:
+            more = fp.read(line_guess + size)
+            if not more:
+                return len(data), data
+            data += more
+            end = data.find("\n", start)
+        start = end + 1
+    while len(data) - start < size:
+        more = fp.read(size - (len(data) - start))
+        if not more:
+            break
+        data += more
+    return start, data
+
+def oversized(size, max_size):
+    """Return why a file of size bytes is too large to license, given
+    max_size as for sniff, or None if it isn't."""
+    if max_size and size > max_size:
+        return "larger than %d bytes" % (max_size)
+    return None
+
+def sniff(fp, size, max_size):
+    """Decide whether a file is one to leave alone: too large, binary, or
+    generated by some tool that would only overwrite the license.  Returns
+    (reason, head), where reason is None if the file is fine and head is
+    what was read from the start of the file to decide, for read_prefix to
+    carry on from.
+
+    fp: the file, open at its start.
+    size: its size in bytes.
+    max_size: largest file to allow, in bytes; 0 for no limit."""
+    reason = oversized(size, max_size)
+    if reason:
+        return reason, None
+    head = fp.read(sniff_size)
+    if "\0" in head:
+        return "binary", head
+    top = "\n".join(head.split("\n", marker_lines)[:marker_lines])
+    if generated_marker.search(top):
+        return "generated", head
+    return None, head
+
+def is_licensed(prefix, print_):
+    """Decide whether prefix begins with a box whose fingerprint is
+    print_."""
+    return fingerprint(prefix).startswith(print_)
+
+def copy_rest(fin, fout):
+    """Copy everything from fin's current position to its end onto fout,
+    byte for byte.  The copy happens inside the kernel where the platform
+    allows it; otherwise it goes through a fixed size buffer, so memory use
+    doesn't depend on the size of the file."""
+    fout.flush()
+    infd, outfd = fin.fileno(), fout.fileno()
+    offset = fin.tell()
+    end = os.fstat(infd).st_size
+    for copier in kernel_copiers:
+        try:
+            while offset < end:
+                n = copier(infd, outfd, offset, end - offset)
+                if not n:
+                    break
+                offset += n
+            if offset >= end:
+                return
+        except OSError as err:
+            if err.errno not in unsupported_errnos:
+                raise
+    # copy whatever remains the slow way
+    os.lseek(infd, offset, os.SEEK_SET)
+    while True:
+        chunk = os.read(infd, copy_buffer)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(outfd, chunk):]
+
+def replace_file(fullpath, st, write, journal = None):
+    """Replace fullpath with what write(fout) puts in a temporary file
+    beside it, which takes over the mode st gives and is renamed over the
+    original once complete.
+
+    journal: journal.Journal to record the change in; the original is kept
+      under another name until the journal is finished with it."""
+    if journal:
+        temp, backup = journal.reserve(fullpath)
+        fout = open(temp, "wb")
+    else:
+        dirname = os.path.dirname(os.path.abspath(fullpath)) + os.sep
+        filename = os.path.basename(fullpath)
+        fout = tempfile.NamedTemporaryFile(prefix = "tmp%s" % filename, 
+                                           dir = dirname, suffix = "txt", 
+                                           delete = False)
+        temp, backup = fout.name, None
+    kept = False
+    try:
+        os.chmod(temp, stat.S_IMODE(st.st_mode))
+        write(fout)
+        fout.close()
+        if backup:
+            keep_original(fullpath, backup)
+            kept = True
+        os.rename(temp, fullpath)
+    except:
+        fout.close()
+        os.remove(temp)
+        if kept:
+            os.remove(backup)
+        raise
+    if journal:
+        journal.done(fullpath, backup)
+
+def keep_original(fullpath, backup):
+    """Make backup another name for fullpath, or failing that, a copy."""
+    try:
+        os.link(fullpath, backup)
+    except OSError as err:
+        if err.errno not in link_errnos:
+            raise
+        shutil.copy2(fullpath, backup)
+
+def apply_license(fullpath, boxed, skip_line, print_ = None, stats = None,
+                  journal = None, max_size = None):
+    """Insert a boxed license into a file after its first skip_line lines.
+    Returns OK, SKIPPED if fullpath isn't a regular file, or (EXCLUDED,
+    reason) if sniff turns it down.
+
+    print_: fingerprint of boxed; if given, files already carrying the box
+      are SKIPPED after reading just enough to find it.
+    stats: timing.Stats to count bytes_read and bytes_written in.
+    journal: as for replace_file.
+    max_size: as for sniff; None not to sniff at all."""
+    st = os.stat(fullpath)
+    if not stat.S_ISREG(st.st_mode):
+        return SKIPPED
+    with open(fullpath, "rb") as fin:
+        head = None
+        if max_size is not None:
+            reason, head = sniff(fin, st.st_size, max_size)
+            if reason:
+                return EXCLUDED, reason
+        if print_ is not None:
+            prefix = read_prefix(fin, skip_line, len(boxed) + prefix_slack,
+                                 head)
+            if stats:
+                stats.count("bytes_read", fin.tell())
+            if is_licensed(prefix, print_):
+                return SKIPPED
+        # sniff and read_prefix leave fin wherever they stopped reading
+        fin.seek(0)
+        def write(fout):
+            for i in range(skip_line):
+                line = fin.readline()
+                fout.write(line)
+            fout.write(boxed + "\n")
+            copy_rest(fin, fout)
+            if stats:
+                stats.count("bytes_read", st.st_size)
+                stats.count("bytes_written",
+                            os.fstat(fout.fileno()).st_size)
+        replace_file(fullpath, st, write, journal)
+    return OK
+
+def filter_license(fin, fout, boxed, skip_line, print_ = None,
+                   max_size = None, size = None):
+    """Copy fin to fout with a boxed license inserted after the first
+    skip_line lines, as apply_license would insert it, without any
+    temporary file and holding no more than the start of the source and a
+    buffer's worth at a time.  Returns OK, SKIPPED if the source already
+    carries the box, or (EXCLUDED, reason) if sniff turns it down; either
+    way the source is copied out unchanged.
+
+    print_: fingerprint of boxed, to skip sources already carrying it.
+    max_size: as for sniff; None not to sniff at all.
+    size: length of the source, if fin isn't a file it can be found out
+      from."""
+    head = None
+    if max_size is not None:
+        if size is None:
+            size = os.fstat(fin.fileno()).st_size
+        reason, head = sniff(fin, size, max_size)
+        if reason:
+            if head:
+                fout.write(head)
+            shutil.copyfileobj(fin, fout, copy_buffer)
+            return EXCLUDED, reason
+    wanted = len(boxed) + prefix_slack
+    start, data = read_head(fin, skip_line, wanted, head)
+    if print_ is not None and is_licensed(data[start:start + wanted],
+                                          print_):
+        status = SKIPPED
+        fout.write(data)
+    else:
+        status = OK
+        fout.write(data[:start])
+        fout.write(boxed + "\n")
+        fout.write(data[start:])
+    shutil.copyfileobj(fin, fout, copy_buffer)
+    return status
+
+def find_box(prefix, frame):
+    """Find the box drawn by frame at the start of prefix and return the
+    offset just past its last line, or None if there isn't one.
+
+    frame: (top, left_wall, bottom), the borders and wall of the profile
+      that drew the box, with empty strings for the parts it doesn't use."""
+    top, wall, bottom = frame
+    lines = prefix.split("\n")[:-1]  # the last line may be cut short
+    pos = 0
+    if top:
+        if not lines or lines[0] != top:
+            return None
+        pos = len(top) + 1
+        lines = lines[1:]
+    first = pos
+    for line in lines:
+        if bottom and line == bottom:
+            return pos + len(line)
+        if not wall or not line.startswith(wall.rstrip()):
+            break
+        pos += len(line) + 1
+    if not bottom and pos > first:
+        return pos - 1
+    return None
+
+def write_at(fd, data, offset):
+    """Write all of data to fd starting at offset."""
+    while data:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, data, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            n = os.write(fd, data)
+        data, offset = data[n:], offset + n
+
+def update_license(fullpath, boxed, skip_line, frame, stats = None,
+                   journal = None, max_size = None):
+    """Replace the box found after the first skip_line lines of a file with
+    boxed, such as to bump the year or change the owner.  A box of the same
+    length is overwritten where it stands; any other change rewrites the
+    file.  Returns OK, SKIPPED if the box is already up to date or fullpath
+    isn't a regular file, MISSING if there's no box to update, or (EXCLUDED,
+    reason) if sniff turns it down.
+
+    frame: as for find_box; the box must be drawn the same way as boxed.
+    stats: timing.Stats to count bytes_read and bytes_written in.
+    journal: as for replace_file; files are always rewritten under one, so
+      that their originals can be kept.
+    max_size: as for sniff; None not to sniff at all."""
+    st = os.stat(fullpath)
+    if not stat.S_ISREG(st.st_mode):
+        return SKIPPED
+    with open(fullpath, "rb") as fin:
+        head = None
+        if max_size is not None:
+            reason, head = sniff(fin, st.st_size, max_size)
+            if reason:
+                return EXCLUDED, reason
+        # the old box may be longer than the new one by a few lines
+        start, prefix = locate_prefix(fin, skip_line,
+                                      2 * len(boxed) + prefix_slack, head)
+        if stats:
+            stats.count("bytes_read", fin.tell())
+        end = find_box(prefix, frame)
+        if end is None:
+            return MISSING
+        if prefix[:end] == boxed:
+            return SKIPPED
+        if end == len(boxed) and not journal:
+            fd = os.open(fullpath, os.O_WRONLY)
+            try:
+                write_at(fd, boxed, start)
+            finally:
+                os.close(fd)
+            if stats:
+                stats.count("bytes_written", len(boxed))
+            return OK
+        def write(fout):
+            fin.seek(0)
+            fout.write(fin.read(start))
+            fout.write(boxed)
+            fin.seek(start + end)
+            copy_rest(fin, fout)
+            if stats:
+                stats.count("bytes_read", st.st_size)
+                stats.count("bytes_written",
+                            os.fstat(fout.fileno()).st_size)
+        replace_file(fullpath, st, write, journal)
+    return OK
+
+def check_license(fullpath, boxed, skip_line, print_ = None, stats = None,
+                  max_size = None):
+    """Check whether a file already carries a box, without writing
+    anything.  Returns OK if it does, MISSING if it doesn't, or (EXCLUDED,
+    reason) if sniff turns it down.
+
+    print_: fingerprint of boxed, if already known.
+    stats: timing.Stats to count bytes_read in.
+    max_size: as for sniff; None not to sniff at all."""
+    if print_ is None:
+        print_ = fingerprint(boxed)
+    # unbuffered, so that only what's asked for is read
+    with open(fullpath, "rb", 0) as fin:
+        head = None
+        if max_size is not None:
+            reason, head = sniff(fin, os.fstat(fin.fileno()).st_size,
+                                 max_size)
+            if reason:
+                return EXCLUDED, reason
+        prefix = read_prefix(fin, skip_line, len(boxed) + prefix_slack,
+                             head)
+        if stats:
+            stats.count("bytes_read", fin.tell())
+    return OK if is_licensed(prefix, print_) else MISSING
+
+def attempt(work, task):
+    """Run work on one task, turning any failure into an ERROR result so
+    that the rest of the batch can carry on.  Returns a tuple of the task,
+    its status and, for errors and exclusions, a description of what went
+    wrong."""
+    try:
+        result = work(*task)
+    except Exception as err:
+        return task, ERROR, str(err)
+    if isinstance(result, tuple):
+        return (task,) + result
+    return task, result, None
+
+def run_pool(work, tasks, jobs = 1):
+    """Generate a result from attempt() for every task as it completes.
+
+    work: function to call with each task's members as arguments.
+    tasks: iterable of argument tuples; consumed lazily.
+    jobs: number of worker threads.  At most a couple of tasks per worker
+      are taken from tasks before their results have been collected."""
+    if jobs <= 1:
+        for task in tasks:
+            yield attempt(work, task)
+        return
+    todo = Queue.Queue(2 * jobs)
+    done = Queue.Queue()
+    stop = object()
+    def worker():
+        while True:
+            task = todo.get()
+            if task is stop:
+                break
+            done.put(attempt(work, task))
+    workers = [threading.Thread(target = worker) for i in range(jobs)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    pending = 0
+    try:
+        for task in tasks:
+            todo.put(task)
+            pending += 1
+            while not done.empty():
+                pending -= 1
+                yield done.get()
+    finally:
+        for thread in workers:
+            todo.put(stop)
+    while pending:
+        pending -= 1
+        yield done.get()
@@ -0,0 +1,304 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Licensing the files inside tar and zip archives on the way to a new
+archive, one member at a time, without unpacking anything to disk.  Members
+that aren't licensed are copied across as they are; in zip archives, where
+each member is compressed on its own, they aren't even decompressed."""
+
+import os
+import copy
+import stat
+import time
+import zlib
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import subprocess
+
+import objects as obj
+import applier
+
+# members being licensed are held in memory up to this size and spooled to
+# a temporary file beyond it
+spool_size = 1 << 20
+# names of tar archives and the compression they imply
+tar_suffixes = [(".tar", ""), (".tar.gz", "gz"), (".tgz", "gz"),
+                (".tar.bz2", "bz2"), (".tbz2", "bz2"), (".tbz", "bz2"),
+                (".tar.xz", "xz"), (".txz", "xz")]
+
+def kind(path):
+    """Return "zip" for a zip archive, or the compression of a tar archive
+    ("", "gz", "bz2" or "xz"), going by its name."""
+    name = path.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    for suffix, compression in tar_suffixes:
+        if name.endswith(suffix):
+            return compression
+    raise obj.RequestError("Not a tar or zip archive: %s" % (path))
+
+def xz(args, stdin, stdout):
+    """Start xz, which Python's tarfile can't do without, on a pipe."""
+    try:
+        return subprocess.Popen(["xz"] + args, stdin = stdin,
+                                stdout = stdout)
+    except OSError as err:
+        raise obj.RequestError("Cannot run xz: %s" % (err))
+
+def spool(content):
+    """Copy a member's content into a file that can be read again."""
+    original = tempfile.SpooledTemporaryFile(spool_size)
+    shutil.copyfileobj(content, original, applier.copy_buffer)
+    original.seek(0)
+    return original
+
+def license_member(clean, name, original, size, mtime):
+    """Run clean over a member's content, as applier.attempt would.
+    Returns the result, as (name, status, detail), and a file holding the
+    licensed content, at its start, or None if the original is to be kept,
+    in which case original is rewound."""
+    out = tempfile.SpooledTemporaryFile(spool_size)
+    task, status, detail = applier.attempt(clean, (name, original, size,
+                                                   mtime, out))
+    if status == applier.OK:
+        out.seek(0)
+        return (name, status, detail), out
+    out.close()
+    original.seek(0)
+    return (name, status, detail), None
+
+def copy_tar(source, compression, fout, out_compression, pick, clean,
+             max_size):
+    """Copy a tar archive to fout a member at a time; see rewrite."""
+    procs = []
+    fin = open(source, "rb")
+    try:
+        stream, mode = fin, "r|*"
+        if compression == "xz":
+            procs.append(xz(["-dc"], fin, subprocess.PIPE))
+            stream, mode = procs[-1].stdout, "r|"
+        out_stream, out_mode = fout, "w|" + out_compression
+        if out_compression == "xz":
+            procs.append(xz(["-c"], subprocess.PIPE, fout))
+            out_stream, out_mode = procs[-1].stdin, "w|"
+        try:
+            src = tarfile.open(fileobj = stream, mode = mode)
+        except tarfile.TarError as err:
+            raise obj.RequestError("Cannot read %s: %s" % (source, err))
+        dst = tarfile.open(fileobj = out_stream, mode = out_mode,
+                           format = tarfile.PAX_FORMAT)
+        for member in src:
+            if not member.isreg():
+                dst.addfile(member)
+                continue
+            content = src.extractfile(member)
+            if not pick(member.name):
+                dst.addfile(member, content)
+                continue
+            reason = applier.oversized(member.size, max_size)
+            if reason:
+                dst.addfile(member, content)
+                yield member.name, applier.EXCLUDED, reason
+                continue
+            original = spool(content)
+            result, licensed = license_member(clean, member.name, original,
+                                              member.size, member.mtime)
+            if licensed:
+                new = copy.copy(member)
+                new.pax_headers = dict(member.pax_headers)
+                new.pax_headers.pop("size", None)
+                licensed.seek(0, os.SEEK_END)
+                new.size = licensed.tell()
+                licensed.seek(0)
+                dst.addfile(new, licensed)
+                licensed.close()
+            else:
+                dst.addfile(member, original)
+            original.close()
+            yield result
+        dst.close()
+        src.close()
+        for proc in procs:
+            if proc.stdin:
+                proc.stdin.close()
+            if proc.stdout:
+                # whatever padding follows the end of the archive
+                while proc.stdout.read(applier.copy_buffer):
+                    pass
+            if proc.wait():
+                raise obj.RequestError("xz failed on %s" % (source))
+    finally:
+        fin.close()
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+                proc.wait()
+
+def copy_raw(raw, info, end, dst):
+    """Copy a zip member's local header and compressed data, up to end, as
+    they are to the end of the zip file dst, and list it there."""
+    new = copy.copy(info)
+    new.header_offset = dst.fp.tell()
+    raw.seek(info.header_offset)
+    left = end - info.header_offset
+    while left > 0:
+        chunk = raw.read(min(left, applier.copy_buffer))
+        if not chunk:
+            raise obj.RequestError("%s is cut short" % (info.filename))
+        dst.fp.write(chunk)
+        left -= len(chunk)
+    dst.filelist.append(new)
+    dst.NameToInfo[new.filename] = new
+    dst._didModify = True
+
+def write_member(dst, info, content):
+    """Compress content, a chunk at a time, to the end of the zip file dst
+    as the member described by info, and list it there.  The local header is
+    written first and filled in once the data is, as ZipFile.write does for
+    files on disk."""
+    info.header_offset = dst.fp.tell()
+    info.flag_bits = 0
+    info.CRC = info.compress_size = 0
+    content.seek(0, os.SEEK_END)
+    info.file_size = content.tell()
+    content.seek(0)
+    # leave room for sizes that may outgrow the header while compressing
+    zip64 = info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    dst.fp.write(info.FileHeader(zip64))
+    compressor = None
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -15)
+    crc = size = 0
+    while True:
+        chunk = content.read(applier.copy_buffer)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+        if compressor:
+            chunk = compressor.compress(chunk)
+        dst.fp.write(chunk)
+        size += len(chunk)
+    if compressor:
+        chunk = compressor.flush()
+        dst.fp.write(chunk)
+        size += len(chunk)
+    info.CRC, info.compress_size = crc & 0xffffffff, size
+    end = dst.fp.tell()
+    dst.fp.seek(info.header_offset)
+    dst.fp.write(info.FileHeader(zip64))
+    dst.fp.seek(end)
+    dst.filelist.append(info)
+    dst.NameToInfo[info.filename] = info
+    dst._didModify = True
+
+def copy_zip(source, fout, pick, clean, max_size):
+    """Copy a zip archive to fout a member at a time; see rewrite."""
+    try:
+        src = zipfile.ZipFile(source)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as err:
+        raise obj.RequestError("Cannot read %s: %s" % (source, err))
+    raw = open(source, "rb")
+    dst = zipfile.ZipFile(fout, "w", allowZip64 = True)
+    try:
+        infos = src.infolist()
+        # each member's data ends where the next one's header starts
+        starts = sorted(set(info.header_offset for info in infos))
+        ends = dict(zip(starts, starts[1:] + [src.start_dir]))
+        for info in infos:
+            name = info.filename
+            # encrypted members, and ones zipfile can't decompress, are left
+            # alone
+            if (info.flag_bits & 0x1 or info.compress_type not in
+                [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED] or
+                not pick(name)):
+                copy_raw(raw, info, ends[info.header_offset], dst)
+                continue
+            reason = applier.oversized(info.file_size, max_size)
+            if reason:
+                copy_raw(raw, info, ends[info.header_offset], dst)
+                yield name, applier.EXCLUDED, reason
+                continue
+            with src.open(info) as content:
+                original = spool(content)
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            result, licensed = license_member(clean, name, original,
+                                              info.file_size, mtime)
+            if licensed:
+                new = zipfile.ZipInfo(name, info.date_time)
+                for attr in ["compress_type", "comment", "create_system",
+                             "external_attr", "internal_attr"]:
+                    setattr(new, attr, getattr(info, attr))
+                write_member(dst, new, licensed)
+                licensed.close()
+            else:
+                copy_raw(raw, info, ends[info.header_offset], dst)
+            original.close()
+            yield result
+        dst.comment = src.comment
+    finally:
+        dst.close()
+        raw.close()
+        src.close()
+
+def rewrite(source, target, pick, clean, max_size = None):
+    """Copy the archive at source to target, licensing the regular files
+    in it on the way, and generate (name, status, detail) for each of those,
+    as applier.attempt does.  A member that can't be licensed is copied as
+    it is.  Tar archives can be compressed differently from the original,
+    but can't be turned into zip archives or the other way around.  target
+    is written beside itself and renamed into place once complete, so it
+    may be the same as source.
+
+    pick: function from a member's name to whether to license it.
+    clean: function licensing a member, given its name, a file holding its
+      content, its size, its modification time and a file to write the
+      licensed content to; returns what applier.filter_license does.
+    max_size: members larger than this are EXCLUDED, without being read;
+      None or 0 for no limit."""
+    if not os.path.isfile(source):
+        raise obj.RequestError("No archive at %s" % (source))
+    compression, out_compression = kind(source), kind(target)
+    if (compression == "zip") != (out_compression == "zip"):
+        raise obj.RequestError("Cannot turn %s into %s" % (source, target))
+    fd, temp = tempfile.mkstemp(prefix = "tmp", suffix = ".part",
+                                dir = os.path.dirname(os.path.abspath(target)))
+    try:
+        with os.fdopen(fd, "w+b") as fout:
+            os.fchmod(fd, stat.S_IMODE(os.stat(source).st_mode))
+            if compression == "zip":
+                members = copy_zip(source, fout, pick, clean, max_size)
+            else:
+                members = copy_tar(source, compression, fout,
+                                   out_compression, pick, clean, max_size)
+            for result in members:
+                yield result
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(temp, target)
+    except:
+        os.remove(temp)
+        raise
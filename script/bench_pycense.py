@@ -0,0 +1,297 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Benchmarks for pycense.  Times box rendering, license substitution,
+loading the configuration, starting pycense and applying licenses to a
+generated tree of source files, and can compare the results against a
+baseline saved by an earlier run:
+
+    bench_pycense.py --output baseline.json
+    bench_pycense.py --baseline baseline.json --threshold 20
+
+Each benchmark reports the best time per operation over several repeats."""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+import platform
+
+import objects as obj
+import applier
+import configstore
+
+cwd = os.path.dirname(os.path.abspath(__file__)) + os.sep
+# roughly the length of the GPL, version 3
+large_size = 35000
+
+def read_license(name):
+    with open(cwd + "licenses" + os.sep + name + ".txt", "r") as fp:
+        return fp.read().rstrip("\n")
+
+def large_license():
+    """Make a license about as long as the GPL out of the short ones."""
+    paragraphs = []
+    for name in ["mit_license", "bsd_2_clause"]:
+        paragraphs.extend(read_license(name).split("\n\n"))
+    text = paragraphs[0]
+    i = 1
+    while len(text) < large_size:
+        text += "\n\n" + paragraphs[i % len(paragraphs)]
+        i += 1
+    return text
+
+def best_time(func, number, repeat):
+    """Return the best time for one call to func over repeat runs of number
+    calls each."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in xrange(number):
+            func()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench_rendering(config, repeat):
+    """Time the pieces of Commentator, its compiled Renderer, Template and
+    Header."""
+    results = {}
+    com = obj.Commentator(config.get_profile("basic_scripting"))
+    results["get_horizontal"] = best_time(lambda: com.get_horizontal("top"),
+                                          10000, repeat)
+    licenses = {"mit": read_license("mit_license"), "large": large_license()}
+    for label, text in sorted(licenses.items()):
+        for width in [40, 79, 120]:
+            com.set_value("width", width)
+            name = "get_boxed/%s/%d" % (label, width)
+            number = 200 if label == "mit" else 5
+            results[name] = best_time(lambda: com.get_boxed(text), number,
+                                      repeat)
+            renderer = com.compile()
+            name = "render/%s/%d" % (label, width)
+            results[name] = best_time(lambda: renderer.render(text), number,
+                                      repeat)
+    values = {"year": "2013", "owner": "Charlie Pashayan", "company": ""}
+    for i in range(30):
+        values["field%d" % i] = "value %d" % i
+    for label, text in sorted(licenses.items()):
+        number = 1000 if label == "mit" else 20
+        results["template_parse/%s" % label] = best_time(
+            lambda: obj.Template(text), number, repeat)
+        template = obj.Template(text)
+        results["template_render/%s" % label] = best_time(
+            lambda: template.render(values), number, repeat)
+    # a license naming each file, boxed from scratch and from a header
+    renderer = com.compile()
+    names = ["src/module%d.py" % i for i in range(100)]
+    for label, text in sorted(licenses.items()):
+        template = obj.Template("<path>\n\n" + text)
+        header = renderer.prepare(template.partial(values, set(["path"])))
+        def full():
+            for path in names:
+                values["path"] = path
+                renderer.render(template.render(values))
+        def partial():
+            for path in names:
+                header.render({"path": path})
+        number = 10 if label == "mit" else 1
+        results["per_file/full/%s" % label] = best_time(full, number,
+                                                        repeat) / len(names)
+        results["per_file/header/%s" % label] = best_time(
+            partial, number, repeat) / len(names)
+    return results
+
+def bench_config(repeat):
+    """Time loading the configuration and a profile from it, parsing
+    config.conf and from a warm cache."""
+    results = {}
+    top = tempfile.mkdtemp(prefix = "bench_pycense")
+    try:
+        path = os.path.join(top, "config.conf")
+        cache = os.path.join(top, "config.cache")
+        shutil.copy(cwd + "config.conf", path)
+        def cold():
+            if os.path.exists(cache):
+                os.remove(cache)
+            configstore.Config(path, cache).get_profile("basic_scripting")
+        def warm():
+            configstore.Config(path, cache).get_profile("basic_scripting")
+        results["config/cold"] = best_time(cold, 20, repeat)
+        warm()
+        results["config/warm"] = best_time(warm, 100, repeat)
+    finally:
+        shutil.rmtree(top)
+    return results
+
+def bench_startup(repeat):
+    """Time starting pycense in a new interpreter, as an editor hook does:
+    importing it alone, and running main() as far as showing the
+    defaults."""
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for label, args in [("import", ["-c", "import pycense"]),
+                            ("main", [cwd + "pycense.py", "--see",
+                                      "defaults"])]:
+            def run():
+                subprocess.check_call([sys.executable] + args, cwd = cwd,
+                                      stdout = devnull)
+            results["startup/" + label] = best_time(run, 5, repeat)
+    return results
+
+def make_tree(top, files, size, suffixes):
+    """Fill top with files of about size bytes, spread over a few levels
+    of directories, with suffixes drawn from suffixes in turn."""
+    rng = random.Random(files)
+    line = "some source code that goes on for a bit;\n"
+    body = line * (size // len(line) + 1)
+    for i in range(files):
+        dirpath = os.path.join(top, "d%d" % (i % 10), "e%d" % (i % 7))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        suffix = suffixes[i % len(suffixes)]
+        path = os.path.join(dirpath, "f%d.%s" % (i, suffix))
+        with open(path, "wb") as fp:
+            fp.write(body[:size - rng.randint(0, size // 10)])
+
+def bench_apply(config, files, size, suffixes, jobs, repeat):
+    """Time applying the MIT license to a generated tree, with each file
+    getting the profile its suffix maps to, then time a second pass that
+    finds every file already licensed."""
+    text = read_license("mit_license")
+    boxes = {}
+    for suffix in suffixes:
+        profile = config.get("suffixes", suffix)
+        com = obj.Commentator(config.get_profile(profile))
+        boxed = com.get_boxed(text)
+        boxes[suffix] = (boxed, com.skip_line, applier.fingerprint(boxed))
+    results = {}
+    for label, skip in [("apply", False), ("reapply", True)]:
+        best = None
+        for i in range(repeat):
+            top = tempfile.mkdtemp(prefix = "bench_pycense")
+            try:
+                make_tree(top, files, size, suffixes)
+                paths = []
+                for dirpath, dirnames, filenames in os.walk(top):
+                    paths.extend(os.path.join(dirpath, filename)
+                                 for filename in filenames)
+                def tasks():
+                    for path in paths:
+                        boxed, skip_line, print_ = boxes[path.rsplit(".")[-1]]
+                        yield path, boxed, skip_line, print_ if skip else None
+                if skip:
+                    list(applier.run_pool(applier.apply_license, tasks(),
+                                          jobs))
+                start = time.time()
+                for task, status, detail in applier.run_pool(
+                        applier.apply_license, tasks(), jobs):
+                    if status == applier.ERROR:
+                        raise RuntimeError("%s: %s" % (task[0], detail))
+                elapsed = (time.time() - start) / files
+            finally:
+                shutil.rmtree(top)
+            if best is None or elapsed < best:
+                best = elapsed
+        results["%s/%d_files/%d_bytes/%d_jobs" % (label, files, size,
+                                                  jobs)] = best
+    return results
+
+def compare(results, baseline, threshold):
+    """Print how results stack up against baseline and return the names of
+    benchmarks that got slower by more than threshold percent."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-40s %12.3gs (new)" % (name, results[name])
+            continue
+        change = 100.0 * (results[name] / baseline[name] - 1)
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print "%-40s %12.3gs %+7.1f%%%s" % (name, results[name], change, flag)
+    return regressions
+
+parser = argparse.ArgumentParser(description = "benchmarks for pycense")
+parser.add_argument("--files", "-n", type = int, default = 500,
+                    help = "number of files in the generated tree")
+parser.add_argument("--size", type = int, default = 8192,
+                    help = "approximate size of each generated file in bytes")
+parser.add_argument("--suffixes", type = str, nargs = "+",
+                    default = ["py", "c", "sql", "html"], metavar = "SUFFIX",
+                    help = ("suffixes to spread over the generated files; "
+                            "each must be associated with a profile"))
+parser.add_argument("--jobs", "-j", type = int, nargs = "+", default = [1, 4],
+                    help = "worker counts to apply licenses with")
+parser.add_argument("--repeat", "-r", type = int, default = 3,
+                    help = "number of times to run each benchmark")
+parser.add_argument("--output", "-o", type = str, metavar = "FILE",
+                    help = "write results to FILE as JSON")
+parser.add_argument("--baseline", "-b", type = str, metavar = "FILE",
+                    help = "compare results to those saved in FILE")
+parser.add_argument("--threshold", "-t", type = float, default = 25.0,
+                    metavar = "PERCENT",
+                    help = ("with --baseline, exit with an error if any "
+                            "benchmark is more than PERCENT slower"))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    cache = tempfile.mkdtemp(prefix = "bench_pycense")
+    try:
+        config = configstore.Config(cwd + "config.conf",
+                                    os.path.join(cache, "config.cache"))
+    finally:
+        shutil.rmtree(cache)
+    results = bench_rendering(config, args.repeat)
+    results.update(bench_config(args.repeat))
+    results.update(bench_startup(args.repeat))
+    for jobs in args.jobs:
+        results.update(bench_apply(config, args.files, args.size,
+                                   args.suffixes, jobs, args.repeat))
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "params": {"files": args.files, "size": args.size,
+                         "suffixes": args.suffixes, "repeat": args.repeat},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent = 2, sort_keys = True)
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print "%d benchmark(s) regressed by more than %g%%" % (
+                len(regressions), args.threshold)
+            sys.exit(1)
+    elif not args.output:
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        print
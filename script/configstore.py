@@ -0,0 +1,153 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Configuration file handling: parsed profiles are cached on disk next to
+the configuration file, and the file is only rewritten when something in it
+has changed."""
+
+import os
+import marshal
+import tempfile
+import ConfigParser
+
+import locking
+
+# bump whenever the layout of the cache changes
+cache_version = 1
+
+class Config(ConfigParser.ConfigParser):
+    """ConfigParser that remembers whether it has been modified and keeps
+    the settings of named profiles around in compiled form.
+
+    path: the configuration file.
+    cache_path: where to keep a compiled copy of the configuration file;
+      it's only trusted while the configuration file's size and
+      modification time match those recorded in it."""
+
+    def __init__(self, path, cache_path):
+        ConfigParser.ConfigParser.__init__(self)
+        self.path = path
+        self.cache_path = cache_path
+        self.dirty = False
+        # (section, option, value) for each change, value None for removals
+        self.changes = []
+        self.profiles = {}
+        self.stamp = self.current_stamp()
+        if not self.load_cache(self.stamp):
+            self.read(path)
+            if self.stamp:
+                self.store_cache(self.stamp)
+
+    def current_stamp(self):
+        """Identify the present version of the configuration file."""
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime, st.st_size, st.st_ino)
+        except OSError:
+            return None
+
+    def stale(self):
+        """Check whether the configuration file has changed since it was
+        read."""
+        return self.current_stamp() != self.stamp
+
+    def load_cache(self, stamp):
+        """Fill in sections and profiles from the cache, if it's current.
+        Returns whether it was."""
+        try:
+            with open(self.cache_path, "rb") as fp:
+                version, cached_stamp, sections, profiles = marshal.load(fp)
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if version != cache_version or cached_stamp != stamp:
+            return False
+        for section, items in sections:
+            self.add_section(section)
+            for option, value in items:
+                ConfigParser.ConfigParser.set(self, section, option, value)
+        self.profiles = profiles
+        return True
+
+    def store_cache(self, stamp):
+        """Compile every profile and write the cache.  A cache that can't
+        be written just means a slower start next time."""
+        for name, value in self.items("profiles"):
+            self.profiles[name] = eval(value)
+        sections = [(section, self.items(section))
+                    for section in self.sections()]
+        data = (cache_version, stamp, sections, self.profiles)
+        try:
+            fd, temp = tempfile.mkstemp(prefix = "tmpcache",
+                                        dir = os.path.dirname(self.cache_path))
+            with os.fdopen(fd, "wb") as fp:
+                marshal.dump(data, fp)
+            os.rename(temp, self.cache_path)
+        except (OSError, IOError):
+            pass
+
+    def get_profile(self, name):
+        """Return a fresh copy of the settings list for a named profile;
+        raises ConfigParser.NoOptionError if there's no such profile."""
+        if name not in self.profiles:
+            self.profiles[name] = eval(self.get("profiles", name))
+        return list(self.profiles[name])
+
+    def set(self, section, option, value = None):
+        ConfigParser.ConfigParser.set(self, section, option, value)
+        self.dirty = True
+        self.changes.append((section, option, value))
+        if section == "profiles":
+            self.profiles.pop(option, None)
+
+    def remove_option(self, section, option):
+        removed = ConfigParser.ConfigParser.remove_option(self, section,
+                                                          option)
+        if removed:
+            self.dirty = True
+            self.changes.append((section, option, None))
+            if section == "profiles":
+                self.profiles.pop(option, None)
+        return removed
+
+    def save(self):
+        """Write the configuration file back out, if anything changed.  The
+        changes are made over again to whatever the file holds by now, under
+        a lock, so that runs changing different settings at the same time
+        don't undo each other's work, and the file is replaced whole, so
+        that nobody reads it half written."""
+        if not self.dirty:
+            return
+        with locking.locked(self.path + ".lock"):
+            current = ConfigParser.ConfigParser()
+            current.read(self.path)
+            for section, option, value in self.changes:
+                if not current.has_section(section):
+                    current.add_section(section)
+                if value is None:
+                    current.remove_option(section, option)
+                else:
+                    current.set(section, option, value)
+            locking.write_atomically(self.path, current.write)
+        self.dirty = False
+        self.changes = []
@@ -0,0 +1,138 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""A long running pycense that keeps its configuration, licenses and boxes
+in memory and takes requests from clients over a Unix socket.  Each request
+and each result is one line of JSON; the server finishes every reply with
+a line saying it's done, so a client can tell a complete reply from a
+server that went away."""
+
+import os
+import errno
+import json
+import socket
+import SocketServer
+
+import objects as obj
+
+def to_str(data):
+    """Recursively convert the unicode strings json produces to utf-8
+    encoded strings, which is what everything else deals in."""
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    elif isinstance(data, list):
+        return [to_str(datum) for datum in data]
+    elif isinstance(data, dict):
+        return dict((to_str(k), to_str(v)) for k, v in data.iteritems())
+    return data
+
+class Handler(SocketServer.StreamRequestHandler):
+    """Read one request, stream back its results."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # someone checking whether we're here
+            return
+        try:
+            request = to_str(json.loads(line))
+            for result in self.server.work(request):
+                self.wfile.write(json.dumps({"result": result}) + "\n")
+            reply = {"done": True}
+        except obj.RequestError as err:
+            reply = {"error": str(err)}
+        except Exception as err:
+            reply = {"error": "pycense daemon failed: %s" % (err)}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # the client hung up; nobody left to tell
+            pass
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serve requests on a Unix socket, each in its own thread.
+
+    work: function taking a request dictionary and generating results."""
+
+    daemon_threads = True
+
+    def __init__(self, path, work):
+        self.work = work
+        if os.path.exists(path):
+            if connect(path):
+                raise obj.RequestError("A pycense daemon is already "
+                                       "listening on %s" % (path))
+            # left behind by a daemon that didn't shut down cleanly
+            os.remove(path)
+        # only the owner gets to hand the daemon files to rewrite
+        umask = os.umask(0o077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        finally:
+            os.umask(umask)
+
+def serve(path, work):
+    """Serve requests on the socket at path until interrupted."""
+    server = Server(path, work)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def connect(path):
+    """Connect to a daemon listening on path; returns None if there isn't
+    one."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as err:
+        sock.close()
+        if err.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK):
+            return None
+        raise
+    return sock
+
+def exchange(sock, request):
+    """Send a request over a connection from connect() and generate the
+    results that come back.  Raises obj.RequestError if the daemon
+    couldn't carry out the request."""
+    try:
+        sock.sendall(json.dumps(request) + "\n")
+        for line in sock.makefile("rb"):
+            reply = to_str(json.loads(line))
+            if "result" in reply:
+                yield tuple(reply["result"])
+            elif "error" in reply:
+                raise obj.RequestError(reply["error"])
+            else:
+                return
+        raise obj.RequestError("pycense daemon went away")
+    finally:
+        sock.close()
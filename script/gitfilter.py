@@ -0,0 +1,165 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""git's long running filter process protocol, as described in
+gitattributes(5) and gitprotocol-long-running-process(5), so that one
+pycense can license every file git checks in.  Everything git and the filter
+say to each other is framed in pkt-lines: four hex digits giving the length
+of the line, those four included, then the data; 0000 is a flush packet,
+ending a list or some content."""
+
+import tempfile
+
+import objects as obj
+
+# most data one packet can carry
+max_packet = 65516
+# content larger than this is spooled to a temporary file until git has
+# sent all of it
+spool_size = 1 << 20
+flush = "0000"
+
+def read_packet(fp):
+    """Read one packet, returning its data or None for a flush packet.
+    Raises EOFError if git has hung up between packets."""
+    header = fp.read(4)
+    if not header:
+        raise EOFError
+    try:
+        length = int(header, 16)
+    except ValueError:
+        length = -1
+    if length == 0:
+        return None
+    if len(header) < 4 or length < 4:
+        raise obj.RequestError("Bad packet header from git: %r" % (header))
+    data = fp.read(length - 4)
+    if len(data) < length - 4:
+        raise obj.RequestError("git hung up in the middle of a packet")
+    return data
+
+def write_packet(fp, data):
+    """Write data as one packet, or as many as it takes."""
+    for start in xrange(0, len(data), max_packet):
+        chunk = data[start:start + max_packet]
+        fp.write("%04x" % (len(chunk) + 4))
+        fp.write(chunk)
+
+def read_list(fp):
+    """Read text packets up to a flush packet, returning their lines."""
+    lines = []
+    while True:
+        data = read_packet(fp)
+        if data is None:
+            return lines
+        lines.append(data.rstrip("\n"))
+
+def write_list(fp, lines):
+    """Write lines as text packets followed by a flush packet, and send
+    them on their way."""
+    for line in lines:
+        write_packet(fp, line + "\n")
+    fp.write(flush)
+    fp.flush()
+
+class PacketWriter:
+    """File-like object writing everything written to it to fp as
+    packets."""
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, data):
+        write_packet(self.fp, data)
+
+def read_content(fp):
+    """Read content up to a flush packet into a file object, positioned at
+    its start, returning it along with its size.  git sends all of it
+    before reading any reply, so it has to be held somewhere."""
+    spool = tempfile.SpooledTemporaryFile(spool_size)
+    size = 0
+    while True:
+        try:
+            data = read_packet(fp)
+        except EOFError:
+            spool.close()
+            raise obj.RequestError("git hung up in the middle of a file")
+        if data is None:
+            break
+        spool.write(data)
+        size += len(data)
+    spool.seek(0)
+    return spool, size
+
+def handshake(fin, fout):
+    """Agree with git on the protocol version and on handling the clean
+    command, which is the only one offered."""
+    try:
+        greeting = read_list(fin)
+        if (greeting[:1] != ["git-filter-client"] or
+            "version=2" not in greeting):
+            raise obj.RequestError("Not a git filter client: %r"
+                                   % (greeting))
+        write_list(fout, ["git-filter-server", "version=2"])
+        capabilities = read_list(fin)
+    except EOFError:
+        raise obj.RequestError("git hung up before agreeing on a protocol")
+    write_list(fout, [line for line in capabilities
+                      if line == "capability=clean"])
+
+def serve(fin, fout, clean, log = None):
+    """Talk to git on fin and fout until it hangs up.
+
+    clean: function taking the path of a file relative to the top of the
+      work tree, a file object holding its content, the size of the
+      content and a file object to write the cleaned content to.
+    log: file object to report files that couldn't be cleaned to."""
+    handshake(fin, fout)
+    while True:
+        try:
+            header = read_list(fin)
+        except EOFError:
+            return
+        keys = dict(line.split("=", 1) for line in header if "=" in line)
+        source, size = read_content(fin)
+        try:
+            if keys.get("command") != "clean" or "pathname" not in keys:
+                write_list(fout, ["status=error"])
+                continue
+            write_list(fout, ["status=success"])
+            try:
+                clean(keys["pathname"], source, size, PacketWriter(fout))
+            except Exception as err:
+                # content may have gone out already; take it back
+                fout.write(flush)
+                write_list(fout, ["status=error"])
+                if log:
+                    log.write("Could not license %s: %s\n"
+                              % (keys["pathname"], err))
+                continue
+            fout.write(flush)
+            # keep the status given before the content
+            write_list(fout, [])
+        finally:
+            source.close()
@@ -0,0 +1,148 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Working out which license, if any, a file already carries.  Every
+license in the library is cut into shingles, runs of a few consecutive
+words, and only a sketch of each is kept: its sketch_size smallest shingle
+hashes, an unbiased sample of the whole.  The sketches go into an index
+from hash to license, so a file is matched by looking up each shingle of
+its prefix once, however many licenses there are; a license scores the
+fraction of its sketch found in the file.  Words are all that count, so the
+comment box around a license, its padding and the years in it make no
+difference.  The index is cached on disk, keyed by the state of the
+library."""
+
+import os
+import re
+import sys
+import heapq
+import marshal
+import tempfile
+import zlib
+
+import applier
+
+# words per shingle
+shingle_words = 4
+# shingle hashes kept per license
+sketch_size = 64
+# least fraction of a license's sketch a file must contain to match it
+min_score = 0.5
+# bump whenever the layout of the cached index or the hashing changes
+index_version = 1
+
+word = re.compile(r"[a-z]+")
+# substitution fields in license templates, which files won't contain
+field = re.compile(r"<[^<>\\\n]*>")
+
+def shingles(text):
+    """Return the set of hashes of the shingles in text."""
+    ids = map(zlib.crc32, word.findall(text.lower()))
+    runs = [ids[i:] for i in range(shingle_words)]
+    return set(map(hash, zip(*runs)))
+
+def build_index(texts):
+    """Build an index of texts, a list of (name, text) pairs of license
+    templates.  The index is a dictionary of plain data, fit for marshal:
+
+    names, sizes: the name of each license and the size of its sketch.
+    postings: shingle hash -> numbers of the licenses whose sketches hold
+      it.
+    longest: length of the longest license, in bytes."""
+    names, sizes, postings, longest = [], [], {}, 0
+    for name, text in texts:
+        sketch = heapq.nsmallest(sketch_size, shingles(field.sub(" ", text)))
+        for shingle in sketch:
+            postings.setdefault(shingle, []).append(len(names))
+        names.append(name)
+        sizes.append(len(sketch))
+        longest = max(longest, len(text))
+    return {"names": names, "sizes": sizes, "postings": postings,
+            "longest": longest}
+
+def best_match(index, text):
+    """Return (name, score) for the license text carries the largest
+    share of, or None if none reaches min_score.  Of licenses that score
+    the same, the one with the larger sketch wins, so that a license
+    isn't mistaken for a shorter one it contains."""
+    postings = index["postings"]
+    counts = {}
+    for shingle in filter(postings.__contains__, shingles(text)):
+        for n in postings[shingle]:
+            counts[n] = counts.get(n, 0) + 1
+    sizes = index["sizes"]
+    best = None
+    for n, count in counts.iteritems():
+        candidate = (float(count) / sizes[n], sizes[n], n)
+        if best is None or candidate > best:
+            best = candidate
+    if best is None or best[0] < min_score:
+        return None
+    return index["names"][best[2]], best[0]
+
+def scan_size(index):
+    """How much of a file to read to find any license in index, allowing
+    for the walls of the box around it."""
+    return index["longest"] * 5 // 4 + 4096
+
+def identify_file(fullpath, index, size, stats = None):
+    """Work out which license a file carries from its first size bytes.
+    Returns (OK, (name, score)), or MISSING if nothing matches.
+
+    stats: timing.Stats to count bytes_read in."""
+    # unbuffered, so that only what's asked for is read
+    with open(fullpath, "rb", 0) as fin:
+        text = fin.read(size)
+    if stats:
+        stats.count("bytes_read", len(text))
+    match = best_match(index, text)
+    if match is None:
+        return applier.MISSING
+    return applier.OK, match
+
+def load_index(source, cache_path):
+    """Return the index of every license in source, a library.Directory or
+    library.Packed, from the cache at cache_path if the library hasn't
+    changed since it was written, building and caching it otherwise."""
+    key = (index_version, shingle_words, sketch_size, sys.maxsize,
+           source.contents_stamp())
+    try:
+        with open(cache_path, "rb") as fp:
+            cached_key, index = marshal.load(fp)
+        if cached_key == key:
+            return index
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    index = build_index([(name, source.read(name))
+                         for name in source.names()])
+    # a cache that can't be written just means a slower start next time
+    try:
+        fd, temp = tempfile.mkstemp(prefix = "tmpidentify",
+                                    dir = os.path.dirname(cache_path))
+        with os.fdopen(fd, "wb") as fp:
+            marshal.dump((key, index), fp)
+        os.rename(temp, cache_path)
+    except (OSError, IOError):
+        pass
+    return index
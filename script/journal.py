@@ -0,0 +1,303 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""A journal of the files a batch run rewrites, so that a run that is
+interrupted can be finished or undone.  Every file rewritten under a journal
+keeps its original contents under a second name, a hard link where
+possible, until the whole run is done.  Rather than syncing every file as
+it's written, files are made durable in groups, and only files in a group
+marked as committed are taken to be done after a crash; everything else is
+put back the way it was."""
+
+import os
+import errno
+import json
+import tempfile
+import threading
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
+import objects as obj
+
+journal_version = 1
+# files written between commits
+commit_every = 1000
+
+def find_syncfs():
+    """Return the C library's syncfs, which flushes a whole filesystem in one
+    call, or None if there isn't one to be had."""
+    if not ctypes:
+        return None
+    try:
+        syncfs = ctypes.CDLL(None, use_errno = True).syncfs
+    except (OSError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    return syncfs
+
+syncfs = find_syncfs()
+
+def fsync_path(path):
+    """Flush a single file or directory to disk, if it's still there."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def sync_paths(paths):
+    """Make the contents of paths and their directory entries durable, with
+    one syncfs for each filesystem involved where the platform has it, or
+    an fsync for every file and directory where it doesn't."""
+    dirs = set(os.path.dirname(path) for path in paths)
+    if syncfs:
+        devices = {}
+        for dirname in dirs:
+            if os.path.isdir(dirname):
+                devices.setdefault(os.stat(dirname).st_dev, dirname)
+        for dirname in devices.values():
+            fd = os.open(dirname, os.O_RDONLY)
+            try:
+                if syncfs(fd) != 0:
+                    raise OSError(ctypes.get_errno(), "syncfs failed on %s"
+                                  % (dirname))
+            finally:
+                os.close(fd)
+        return
+    for path in list(paths) + list(dirs):
+        fsync_path(path)
+
+def to_str(data):
+    """Recursively turn the unicode strings json produces back into the byte
+    strings that went in; paths needn't be valid utf-8, so everything goes
+    through latin-1, which maps bytes to code points one for one."""
+    if isinstance(data, unicode):
+        return data.encode("latin-1")
+    elif isinstance(data, list):
+        return [to_str(datum) for datum in data]
+    elif isinstance(data, dict):
+        return dict((to_str(k), to_str(v)) for k, v in data.iteritems())
+    return data
+
+def dump(record):
+    return json.dumps(record, encoding = "latin-1") + "\n"
+
+def remove(path):
+    """Remove path if it's there."""
+    try:
+        os.remove(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+
+class Journal:
+    """The journal of a run in progress.  It's safe to use from several
+    threads at once.
+
+    path: where the journal is kept; unless resuming, there mustn't be one
+      there already.
+    request: the request being run, for --resume to run again.
+    carried: when resuming, plan records of files already done by an earlier
+      attempt at the same run, whose originals still need keeping; see
+      recover."""
+
+    def __init__(self, path, request, carried = [], resume = False):
+        if not resume and os.path.exists(path):
+            raise obj.RequestError("An interrupted run is recorded in %s; "
+                                   "finish it with --resume or undo it with "
+                                   "--rollback" % (path))
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.backups = [record["backup"] for record in carried]
+        # files done since the last commit
+        self.pending = []
+        # start from a complete journal, carried over files and all, which
+        # replaces any journal of an earlier attempt in one go
+        fd, temp = tempfile.mkstemp(prefix = "tmpjournal",
+                                    dir = os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(dump({"op": "begin", "version": journal_version,
+                           "request": request}))
+            for record in carried:
+                fp.write(dump(record))
+                fp.write(dump({"op": "done", "path": record["path"]}))
+            fp.write(dump({"op": "commit"}))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temp, path)
+        self.fp = open(path, "ab")
+
+    def write(self, record):
+        """Append a record; it survives the process dying, though not the
+        machine crashing until the next commit."""
+        self.fp.write(dump(record))
+        self.fp.flush()
+
+    def reserve(self, fullpath):
+        """Record that fullpath is about to be rewritten and return the
+        names to use for its new contents and for keeping the old."""
+        dirname, filename = os.path.split(fullpath)
+        with self.lock:
+            self.count += 1
+            stem = os.path.join(dirname, "tmp%s.%d.%d" % (filename,
+                                                          os.getpid(),
+                                                          self.count))
+            temp, backup = stem + ".txt", stem + ".orig"
+            self.write({"op": "plan", "path": fullpath, "temp": temp,
+                        "backup": backup})
+        return temp, backup
+
+    def done(self, fullpath, backup):
+        """Record that fullpath has been rewritten, committing if enough
+        files have been since the last commit."""
+        with self.lock:
+            self.write({"op": "done", "path": fullpath})
+            self.backups.append(backup)
+            self.pending.append(fullpath)
+            if len(self.pending) >= commit_every:
+                self.commit()
+
+    def commit(self):
+        """Make every file done so far durable, then say so in the
+        journal.  Call with the lock held."""
+        if self.pending:
+            sync_paths(self.pending)
+        self.write({"op": "commit"})
+        os.fsync(self.fp.fileno())
+        self.pending = []
+
+    def finish(self):
+        """Commit what's left, then drop the originals and the journal."""
+        with self.lock:
+            self.commit()
+            self.write({"op": "end"})
+            os.fsync(self.fp.fileno())
+            self.fp.close()
+            for backup in self.backups:
+                remove(backup)
+            os.remove(self.path)
+
+def load(path):
+    """Read a journal and return the request it records, the plan records
+    of its files in order, the set of paths committed as done, and whether
+    the run ended."""
+    try:
+        fp = open(path, "rb")
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            raise obj.RequestError("No interrupted run recorded in %s"
+                                   % (path))
+        raise
+    request, plans, done, committed, ended = None, [], [], set(), False
+    with fp:
+        for line in fp:
+            try:
+                record = to_str(json.loads(line))
+            except ValueError:
+                # the last line may be cut short
+                break
+            op = record["op"]
+            if op == "begin":
+                if record["version"] != journal_version:
+                    raise obj.RequestError("Can't read the journal in %s"
+                                           % (path))
+                request = record["request"]
+            elif op == "plan":
+                plans.append(record)
+            elif op == "done":
+                done.append(record["path"])
+            elif op == "commit":
+                committed.update(done)
+                done = []
+            elif op == "end":
+                ended = True
+    if request is None:
+        raise obj.RequestError("Can't read the journal in %s" % (path))
+    return request, plans, committed, ended
+
+def undo(record):
+    """Put back the original of a file that a plan record describes, and
+    clear away anything left over from rewriting it."""
+    remove(record["temp"])
+    path, backup = record["path"], record["backup"]
+    if not os.path.exists(backup):
+        # the file was never touched
+        return False
+    if os.path.exists(path) and os.path.samefile(path, backup):
+        # the new contents were never moved into place
+        os.remove(backup)
+        return False
+    os.rename(backup, path)
+    return True
+
+def clean_up(path, plans):
+    """Drop what's left of a run that ended."""
+    for record in plans:
+        remove(record["temp"])
+        remove(record["backup"])
+    os.remove(path)
+
+def rollback(path):
+    """Undo an interrupted run, returning how many files were restored.  A
+    run that got as far as ending can't be undone; only its leftovers are
+    cleared away."""
+    request, plans, committed, ended = load(path)
+    if ended:
+        clean_up(path, plans)
+        return 0
+    restored = 0
+    for record in reversed(plans):
+        if undo(record):
+            restored += 1
+    sync_paths([record["path"] for record in plans])
+    os.remove(path)
+    return restored
+
+def recover(path):
+    """Prepare to resume an interrupted run: undo whatever wasn't committed,
+    and return the request to run again together with the plan records of
+    the files that are done, to pass on to a Journal resuming the run, which
+    replaces this one.  Returns None for the request if the run had ended
+    after all."""
+    request, plans, committed, ended = load(path)
+    if ended:
+        clean_up(path, plans)
+        return None, []
+    carried = []
+    for record in reversed(plans):
+        if record["path"] in committed:
+            carried.append(record)
+        else:
+            undo(record)
+    carried.reverse()
+    sync_paths([record["path"] for record in plans])
+    return request, carried
@@ -0,0 +1,262 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""The license library.  Licenses live either as one text file apiece in a
+directory, or packed into a single file: a header pointing at an index of
+names, followed by the texts themselves.  A pack is memory mapped and texts
+are only read when asked for, and changes are appended along with a new
+index, so that adding, renaming or removing a license doesn't mean
+rewriting the whole library.  Space left behind by old texts and indexes is
+reclaimed once it outgrows what's still in use.  Changes of either kind are
+made under a lock, and files are only ever replaced whole."""
+
+import os
+import mmap
+import marshal
+import struct
+
+import objects as obj
+import locking
+
+pack_magic = "PYCLIB1\n"
+# magic, then the offset and length of the index
+header_format = "<8sQQ"
+header_size = struct.calcsize(header_format)
+# packs smaller than this are never worth compacting
+compact_minimum = 1 << 16
+
+class Directory:
+    """A library kept as a directory of name.txt files.
+
+    lock_path: lock file to hold while changing the library; by default,
+      the directory's name with .lock added."""
+
+    def __init__(self, path, lock_path = None):
+        self.path = path
+        self.lock_path = lock_path or path.rstrip(os.sep) + ".lock"
+
+    def file_path(self, name):
+        """Return the path of the file holding a license."""
+        return os.path.join(self.path, name + ".txt")
+
+    def names(self):
+        """Return the names of the licenses, sorted."""
+        return sorted(filename[:-len(".txt")]
+                      for filename in os.listdir(self.path)
+                      if filename.endswith(".txt"))
+
+    def stamp(self, name):
+        """Return something that changes whenever a license does, or None if
+        there's no license by that name."""
+        try:
+            st = os.stat(self.file_path(name))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def contents_stamp(self):
+        """Return something that changes whenever any license is added,
+        removed or changed."""
+        return tuple((name,) + self.stamp(name) for name in self.names())
+
+    def read(self, name):
+        with open(self.file_path(name), "r") as fp:
+            return fp.read()
+
+    def add(self, name, text):
+        """Add a license, replacing any by the same name."""
+        with locking.locked(self.lock_path):
+            locking.write_atomically(self.file_path(name),
+                                     lambda fp: fp.write(text))
+
+    def rename(self, old, new):
+        """Rename a license; returns False if there's none by the old
+        name."""
+        with locking.locked(self.lock_path):
+            try:
+                os.rename(self.file_path(old), self.file_path(new))
+            except OSError:
+                return False
+        return True
+
+    def remove(self, name):
+        """Remove a license; returns False if there's none by that name."""
+        with locking.locked(self.lock_path):
+            try:
+                os.remove(self.file_path(name))
+            except OSError:
+                return False
+        return True
+
+class Packed:
+    """A library kept in a single pack file; see the module docstring.
+
+    lock_path: lock file to hold while changing the library; by default,
+      the pack's name with .lock added."""
+
+    def __init__(self, path, lock_path = None):
+        self.path = path
+        self.lock_path = lock_path or path + ".lock"
+        self.map = None
+        self.load()
+
+    def load(self):
+        """(Re)read the header and index of the pack."""
+        if self.map:
+            self.map.close()
+        with open(self.path, "rb") as fp:
+            st = os.fstat(fp.fileno())
+            self.ident = (st.st_mtime, st.st_size, st.st_ino)
+            self.map = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, offset, length = struct.unpack(header_format,
+                                              self.map[:header_size])
+        if magic != pack_magic:
+            raise obj.RequestError("%s is not a license library"
+                                   % (self.path))
+        # name -> (offset, length) of its text
+        self.index = marshal.loads(self.map[offset:offset + length])
+
+    def file_path(self, name):
+        """Packed licenses have no file of their own."""
+        return None
+
+    def names(self):
+        return sorted(self.index)
+
+    def stamp(self, name):
+        if name not in self.index:
+            return None
+        return (self.ident[2],) + self.index[name]
+
+    def contents_stamp(self):
+        return self.ident
+
+    def read(self, name):
+        offset, length = self.index[name]
+        return self.map[offset:offset + length]
+
+    def add(self, name, text):
+        with locking.locked(self.lock_path):
+            self.load()
+            self.append(dict(self.index), [(name, text)])
+
+    def rename(self, old, new):
+        with locking.locked(self.lock_path):
+            self.load()
+            if old not in self.index:
+                return False
+            index = dict(self.index)
+            index[new] = index.pop(old)
+            self.append(index, [])
+        return True
+
+    def remove(self, name):
+        with locking.locked(self.lock_path):
+            self.load()
+            if name not in self.index:
+                return False
+            index = dict(self.index)
+            del index[name]
+            self.append(index, [])
+        return True
+
+    def append(self, index, texts):
+        """Write texts and then index, which should already list every other
+        license, at the end of the pack, and only then point the header at
+        the new index, so that a pack cut short by a crash still reads as it
+        was.  Compacts the pack instead if it's mostly dead space.  Call
+        with the lock held and the index freshly loaded."""
+        with open(self.path, "r+b") as fp:
+            fp.seek(0, os.SEEK_END)
+            end = fp.tell()
+            for name, text in texts:
+                fp.write(text)
+                index[name] = (end, len(text))
+                end += len(text)
+            data = marshal.dumps(index)
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.seek(0)
+            fp.write(struct.pack(header_format, pack_magic, end, len(data)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.load()
+        live = header_size + len(data)
+        for offset, length in self.index.values():
+            live += length
+        size = end + len(data)
+        if size > compact_minimum and size > 2 * live:
+            write_pack(self.path, [(name, self.read(name))
+                                   for name in self.names()])
+            self.load()
+
+def write_pack(path, texts):
+    """Write a fresh pack holding texts, a list of (name, text), and move it
+    into place at path in one go."""
+    def write(fp):
+        end = header_size
+        index = {}
+        fp.seek(header_size)
+        for name, text in texts:
+            fp.write(text)
+            index[name] = (end, len(text))
+            end += len(text)
+        data = marshal.dumps(index)
+        fp.write(data)
+        fp.seek(0)
+        fp.write(struct.pack(header_format, pack_magic, end, len(data)))
+    locking.write_atomically(path, write)
+
+def open_library(directory, pack_path):
+    """Return the library: the pack if there is one, else the directory.
+    Both share the directory's lock file."""
+    lock_path = directory.rstrip(os.sep) + ".lock"
+    if os.path.exists(pack_path):
+        return Packed(pack_path, lock_path)
+    return Directory(directory, lock_path)
+
+def pack(directory, pack_path):
+    """Pack every license in directory into a new pack at pack_path."""
+    source = Directory(directory)
+    with locking.locked(source.lock_path):
+        write_pack(pack_path, [(name, source.read(name))
+                               for name in source.names()])
+
+def unpack(pack_path, directory):
+    """Write every license in the pack out to directory, then remove the
+    pack, so that the directory is the library again.  Licenses left in the
+    directory that the pack doesn't hold, such as ones removed or renamed
+    while it was packed, are removed."""
+    target = Directory(directory)
+    with locking.locked(target.lock_path):
+        source = Packed(pack_path)
+        names = source.names()
+        for name in names:
+            locking.write_atomically(target.file_path(name),
+                                     lambda fp: fp.write(source.read(name)))
+        for name in set(target.names()) - set(names):
+            os.remove(target.file_path(name))
+        # the pack goes last, so an interrupted unpack can be done again
+        os.remove(pack_path)
@@ -0,0 +1,74 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Advisory locking and atomic file replacement, so that any number of
+pycense processes can share one configuration and license library.  Only
+processes that change something take a lock; everyone else reads files
+that are only ever replaced whole."""
+
+import os
+import stat
+import tempfile
+import contextlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+@contextlib.contextmanager
+def locked(path):
+    """Hold an exclusive advisory lock on the lock file at path, creating
+    it if need be, for the duration of a with block.  Where the platform
+    has no fcntl, nothing is locked."""
+    if not fcntl:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing releases the lock
+        os.close(fd)
+
+def write_atomically(path, write):
+    """Replace path with what write(fp) puts in a temporary file beside it,
+    flushed to disk first, so that readers see either all of the old file
+    or all of the new one.  The new file keeps the old one's mode."""
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0o644
+    fd, temp = tempfile.mkstemp(prefix = "tmp" + os.path.basename(path),
+                                dir = os.path.dirname(path))
+    try:
+        os.chmod(temp, mode)
+        with os.fdopen(fd, "wb") as fp:
+            write(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
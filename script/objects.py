@@ -24,7 +24,8 @@
 import sys
 import os
 import re
-from textwrap import wrap
+import string
+import textwrap
 from itertools import izip
 import argparse
 
@@ -36,6 +37,69 @@ settings_abbrevs = {"tb": "top_begin", "tf": "top_fill", "te": "top_end",
                     "be": "bottom_end", "br": "bottom_rjust", "w": "width",
                     "t": "tab", "sl": "skip_line"}
 
+# wrap() works like textwrap.wrap with its default options
+space_runs = re.compile(r"( +)")
+word_pieces = re.compile(textwrap.TextWrapper.wordsep_re.pattern)
+to_spaces = string.maketrans(string.whitespace, " " * len(string.whitespace))
+# paragraphs wrapped so far, by paragraph and width
+layouts = {}
+layouts_limit = 4096
+
+def wrap(text, width):
+    """Break text into lines no longer than width, exactly as
+    textwrap.wrap(text, width) does, but in time linear in the length of
+    text: only words containing hyphens are handed to textwrap's regular
+    expression, and long words are cut up without copying what's left of
+    them over and over."""
+    if width <= 0:
+        raise ValueError("invalid width %r (must be > 0)" % width)
+    text = text.expandtabs().translate(to_spaces)
+    chunks = []
+    for piece in space_runs.split(text):
+        if "-" in piece and piece[0] != " ":
+            chunks.extend(chunk for chunk in word_pieces.split(piece) if chunk)
+        elif piece:
+            chunks.append(piece)
+    lines = []
+    i, n = 0, len(chunks)
+    cut = 0 # characters of chunks[i] that went on earlier lines
+    while i < n:
+        # whitespace at the start of a line is dropped, except on the first
+        if lines and chunks[i][cut] == " ":
+            i, cut = i + 1, 0
+        line = []
+        length = 0
+        while i < n and length + len(chunks[i]) - cut <= width:
+            line.append(chunks[i][cut:])
+            length += len(chunks[i]) - cut
+            i, cut = i + 1, 0
+        # a chunk that doesn't fit on any line is split across lines
+        if i < n and len(chunks[i]) - cut > width:
+            line.append(chunks[i][cut:cut + width - length])
+            cut += width - length
+        if line and not line[-1].strip():
+            del line[-1]
+        if line:
+            lines.append("".join(line))
+    return lines
+
+def layout(paragraph, width):
+    """Return wrap(paragraph, width) as a tuple, remembering it so that
+    rendering the same text again, for another profile of the same width or
+    with different substitutions elsewhere, skips paragraphs already
+    wrapped."""
+    key = (paragraph, width)
+    lines = layouts.get(key)
+    if lines is None:
+        if len(layouts) >= layouts_limit:
+            layouts.clear()
+        lines = layouts[key] = tuple(wrap(paragraph, width))
+    return lines
+
+class RequestError(Exception):
+    """Raised when pycense is asked to do something it can't; the message
+    is meant for the user."""
+
 class Commentator:
     """Class for generating boxed comments according to a specifications 
     string.
@@ -163,36 +227,221 @@ class Commentator:
 
         text: any printable text that does not include tabs and paragraphs
         should be divided by bare newlines."""
-        def cond_append(l, s):
-            if s:
-                l.append(s)
-        if text[-1] == "\n":
-            text = text[:-1]
-        comment_lines = []
-        cond_append(comment_lines, self.get_horizontal("top"))
-        tabwidth = self.sr("tab", 8)
-        walls_width = len(self.sr("left_wall")) + len(self.sr("right_wall"))
-        line_width = self.width - walls_width
-        # futz with text a bit
-        text = text.expandtabs(tabwidth)
-        # break into paragraphs, force paragraphs to line_width,
-        p_list = [wrap(p, line_width) for p in text.split("\n\n")]
-        lines = []
-        # blank lines to separate paragraphs; ignore extra blank line
-        map(lambda s: lines.extend(s + [""]), p_list)
-        for line in lines[:-1]:
-            nspaces = self.width - (walls_width + len(line))
-            cond_append(comment_lines, ("%s%s%s%s" % (self.sr("left_wall"), 
-                                                      line,
-                                                      " " * nspaces,
-                                                      self.sr("right_wall"))))
-        cond_append(comment_lines, self.get_horizontal("bottom"))
-        return "\n".join(comment_lines)
+        return self.compile().render(text)
+
+    def compile(self):
+        """Freeze the current settings into a Renderer, which draws the
+        same boxes as get_boxed without looking anything up again."""
+        return Renderer(self)
                 
     def get_storage(self):
         """Generate tuple list to store current settings."""
         return str([(var, getattr(self, var)) for var in vars(self)])
 
+class Renderer(object):
+    """Read only snapshot of a Commentator's settings, with everything that
+    doesn't depend on the text worked out in advance.  Made by
+    Commentator.compile.
+
+    top, bottom: the borders, or empty strings for none.
+    left_wall, right_wall: as for Commentator.
+    width, text_width: width of the box and of the text within the walls.
+    tab, skip_line: as for Commentator.
+    blank: the line separating paragraphs."""
+    __slots__ = ["top", "bottom", "left_wall", "right_wall", "width",
+                 "text_width", "tab", "skip_line", "blank"]
+
+    def __init__(self, com):
+        com.validate()
+        left_wall, right_wall = com.sr("left_wall"), com.sr("right_wall")
+        text_width = com.width - len(left_wall) - len(right_wall)
+        values = {"top": com.get_horizontal("top"),
+                  "bottom": com.get_horizontal("bottom"),
+                  "left_wall": left_wall, "right_wall": right_wall,
+                  "width": com.width, "text_width": text_width,
+                  "tab": com.sr("tab", 8), "skip_line": com.sr("skip_line", 0),
+                  "blank": left_wall + " " * text_width + right_wall}
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Renderer settings can't be changed; change the "
+                             "Commentator and compile it again")
+
+    def render(self, text):
+        """Enclose text in a comment box, as Commentator.get_boxed does."""
+        if text[-1:] == "\n":
+            text = text[:-1]
+        text_width = self.text_width
+        paragraphs = [layout(p, text_width)
+                      for p in text.expandtabs(self.tab).split("\n\n")]
+        # one line per line of text, plus one between each paragraph
+        count = len(paragraphs) - 1
+        for lines in paragraphs:
+            count += len(lines)
+        first = 1 if self.top else 0
+        out = [self.blank] * (first + count + (1 if self.bottom else 0))
+        if self.top:
+            out[0] = self.top
+        if self.bottom:
+            out[-1] = self.bottom
+        left_wall, right_wall = self.left_wall, self.right_wall
+        i = first
+        for lines in paragraphs:
+            for line in lines:
+                out[i] = left_wall + line.ljust(text_width) + right_wall
+                i += 1
+            # the blank line after the paragraph is already in place
+            i += 1
+        return "\n".join(out)
+
+    def box_lines(self, text, cache = True):
+        """Return the lines render would put between the borders for text,
+        which shouldn't end in a newline.
+
+        cache: False to wrap text without remembering it (see layout), for
+          text that isn't likely to come up again."""
+        text_width = self.text_width
+        left_wall, right_wall = self.left_wall, self.right_wall
+        out = []
+        for paragraph in text.expandtabs(self.tab).split("\n\n"):
+            out.append(self.blank)
+            lines = (layout(paragraph, text_width) if cache
+                     else wrap(paragraph, text_width))
+            for line in lines:
+                out.append(left_wall + line.ljust(text_width) + right_wall)
+        return out[1:]
+
+    def prepare(self, template):
+        """Return a Header for a license Template whose remaining fields
+        are to be filled in differently for each file."""
+        return Header(self, template)
+
+class Header:
+    """A license boxed by a Renderer with some <fields> still to fill in.
+    Paragraphs without fields are wrapped and boxed once; only the others
+    are wrapped again each time the header is rendered, and the lot are
+    spliced together.  Made by Renderer.prepare.
+
+    renderer: the Renderer.
+    template: the Template.
+    pieces: lists of lines already boxed, between Templates of the
+      paragraphs with fields.
+    last: the Template of the last paragraph, if it has fields.
+    strip_last: whether a newline ending the last paragraph is to be
+      dropped, as render drops one ending the text."""
+
+    def __init__(self, renderer, template):
+        self.renderer = renderer
+        self.template = template
+        # each field becomes a NUL to find the paragraphs it falls in
+        text = "\0".join(template.literals)
+        self.strip_last = text[-1:] != "\n"
+        if not self.strip_last:
+            text = text[:-1]
+        fields = iter(template.fields)
+        self.pieces = []
+        self.last = None
+        lines = [renderer.top] if renderer.top else []
+        for i, paragraph in enumerate(text.split("\n\n")):
+            if i:
+                lines.append(renderer.blank)
+            if "\0" in paragraph:
+                piece = Template("")
+                piece.literals = paragraph.split("\0")
+                piece.fields = [fields.next() for i in piece.literals[1:]]
+                self.pieces.extend([lines, piece])
+                self.last = piece
+                lines = []
+            else:
+                lines.extend(renderer.box_lines(paragraph))
+                self.last = None
+        if renderer.bottom:
+            lines.append(renderer.bottom)
+        self.pieces.append(lines)
+
+    def render(self, values):
+        """Return the boxed license with its fields filled in, just as the
+        renderer would box the filled in template.
+
+        values: dictionary mapping field names to replacement strings."""
+        out = []
+        for piece in self.pieces:
+            if type(piece) is list:
+                out.extend(piece)
+                continue
+            text = piece.render(values)
+            if piece is self.last and self.strip_last and not text:
+                # the newline render drops would come out of the blank
+                # line before it; do it the long way
+                return self.renderer.render(self.template.render(values))
+            if text[-1:] == "\n":
+                if piece is not self.last:
+                    # the newline would run into the blank line after it
+                    # and split the text differently; likewise
+                    return self.renderer.render(self.template.render(values))
+                if self.strip_last:
+                    text = text[:-1]
+            out.extend(self.renderer.box_lines(text, False))
+        return "\n".join(out)
+
+class Template:
+    """A license parsed once into literal text and <brocketed fields>, so
+    that it can be filled in any number of times with a single pass.
+
+    Doubled backslashes stand for one backslash, and a brocketed string
+    preceded by a single backslash is literal text, backslash removed.
+    Fields with no value given are left as they appear."""
+
+    token = re.compile(r"\\\\|\\(<[^<>\\\n]*>)|<([^<>\\\n]*)>")
+
+    def __init__(self, text):
+        """Break text into alternating literals and field names."""
+        self.literals = []
+        self.fields = []
+        pieces = []
+        pos = 0
+        for m in self.token.finditer(text):
+            pieces.append(text[pos:m.start()])
+            pos = m.end()
+            escaped, field = m.groups()
+            if field is not None:
+                self.literals.append("".join(pieces))
+                self.fields.append(field)
+                pieces = []
+            elif escaped is not None:
+                pieces.append(escaped)
+            else:
+                pieces.append("\\")
+        pieces.append(text[pos:])
+        self.literals.append("".join(pieces))
+
+    def render(self, values):
+        """Fill in the fields.
+
+        values: dictionary mapping field names to replacement strings."""
+        out = [self.literals[0]]
+        for field, literal in izip(self.fields, self.literals[1:]):
+            out.append(values.get(field, "<%s>" % (field)))
+            out.append(literal)
+        return "".join(out)
+
+    def partial(self, values, keep):
+        """Fill in every field but those named in keep, returning a Template
+        of what's left to fill in.
+
+        values: as for render."""
+        rest = Template("")
+        rest.literals = [self.literals[0]]
+        for field, literal in izip(self.fields, self.literals[1:]):
+            if field in keep:
+                rest.fields.append(field)
+                rest.literals.append(literal)
+            else:
+                rest.literals[-1] += values.get(field, "<%s>" % (field))
+                rest.literals[-1] += literal
+        return rest
+
 class SetAction(argparse.Action):
     """Class to handle applying settings from the command line, simplifying
     the process of retreiving settings that have been explicitly set."""
@@ -221,10 +470,10 @@ class ValueAdded(argparse.Action):
 
     def __call__(self, parser, namespace, values, option_string):
         if len(values) % 2:
-            message = ("You must provide a filepath and a license name "
-                       "for each license you wish to import.")
+            message = ("You must provide a field name and a value "
+                       "for each substitution you wish to make.")
             raise argparse.ArgumentError(None, message)
-        namespace.value.extend(zip(values[::2], values[1::2]))
+        namespace.substitute_value.extend(zip(values[::2], values[1::2]))
 
 class SeeSomeAction(argparse.Action):
     """Class of action for when see is called, to verify that any further 
@@ -24,15 +24,22 @@
 import os
 import sys
 import objects as obj
+import walker
+import applier
+import configstore
+import library
+import timing
 import argparse
 import ConfigParser
 import re
 import shutil
-import stat
-import tempfile
 import pprint
 import datetime
 import subprocess
+import itertools
+import collections
+import tempfile
+import json
 
 __version__ = "1.0"
 __author__ = "Charlie Pashayan"
@@ -40,31 +47,600 @@ __prog__ = "pycense"
 
 cwd = os.path.dirname(os.path.abspath(__file__)) + os.sep
 
-def name_to_path(name):
-    """Creates a path to a license out of its name."""
-    return cwd + "licenses" + os.sep + name + ".txt"
-
 def terminate(code):
     """Store modified config settings and exit."""
-    with open(config_file, "wb") as fp:
-        config.write(fp)
+    config.save()
+    sys.stdout.flush()
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+        if tracemalloc and tracemalloc.is_tracing():
+            stats.count("traced_peak_bytes",
+                        tracemalloc.get_traced_memory()[1])
+    if show_stats:
+        sys.stderr.write(json.dumps(stats.report(), sort_keys = True) + "\n")
     os._exit(code)
 
 config_file = cwd + "config.conf"
+cache_file = cwd + "config.cache"
 manual_file = cwd + "pycense.6"
+socket_file = cwd + "pycense.sock"
+journal_file = cwd + "pycense.journal"
+license_dir = cwd + "licenses"
+pack_file = cwd + "licenses.pack"
+identify_cache_file = cwd + "identify.cache"
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# filled in whether or not anyone asks to see it; it's cheap
+stats = timing.Stats()
+show_stats = False
+profiler = None
+profile_file = None
+
+# the license library, with the stat of its pack when it was opened
+lib = None
+lib_stamp = None
+# licenses by name, as (library stamp, text, template)
+licenses = {}
+# compiled commentators by profile and explicit settings
+renderers = {}
+# boxes by profile, explicit settings and license text, as
+# (box, skip_line, fingerprint, frame)
+boxes = {}
+# objects.Headers for licenses with fields filled in for each file, by
+# profile, explicit settings and license template, as
+# (header, skip_line, frame)
+headers = {}
+# fields that are filled in differently for each file (see file_values)
+file_fields = ["filename", "path", "module"]
+
+# the configuration file and the defaults it holds, read on first use (see
+# ensure_config) so that importing pycense doesn't touch the disk
+config = None
+d_license = d_company = d_owner = d_editor = d_settings = d_max_size = None
+
+def load_config():
+    """(Re)read the configuration file and the defaults it holds."""
+    global config, d_license, d_company, d_owner, d_editor, d_settings
+    global d_max_size
+    config = configstore.Config(config_file, cache_file)
+    d_license = config.get("defaults", "license")
+    d_company = config.get("defaults", "company")
+    d_owner = config.get("defaults", "owner")
+    d_editor = config.get("defaults", "editor")
+    if config.has_option("defaults", "max_size"):
+        d_max_size = config.getint("defaults", "max_size")
+    else:
+        d_max_size = 0
+    d_settings = {("tab", config.getint("defaults", "tab")),
+                  ("width", config.getint("defaults", "width")),
+                  ("skip_line", config.getint("defaults", "skip_line"))}
+    renderers.clear()
+    boxes.clear()
+    headers.clear()
+
+def ensure_config():
+    """Read the configuration file if it hasn't been read yet, or again if
+    it has changed since, and return it."""
+    if config is None or config.stale():
+        with stats.phase("config"):
+            load_config()
+    return config
+
+def build_commentator(profile, explicit_settings):
+    """Create a Commentator from a named profile (or None), overriding its
+    settings with those set explicitly and filling gaps with defaults."""
+    if profile:
+        # load settings from named profile
+        try:
+            settings = config.get_profile(str(profile))
+        except ConfigParser.NoOptionError:
+            raise obj.RequestError("No settings profile named %s" % (profile))
+    else:
+        settings = []
+    for setting, value in explicit_settings:
+        # swap in any settings explicitly set in the cmdline
+        settings.append((setting, value))
+    for setting, value in d_settings:
+        # only swap in default settings if not set elsewhere
+        if setting not in [t[0] for t in settings]:
+            settings.append((setting, value))
+    return obj.Commentator(settings)
+
+def get_library():
+    """Return the license library, opening it again if it has been packed,
+    unpacked or changed by someone else since it was last opened."""
+    global lib, lib_stamp
+    try:
+        st = os.stat(pack_file)
+        stamp = (st.st_mtime, st.st_size, st.st_ino)
+    except OSError:
+        stamp = None
+    if lib is None or stamp != lib_stamp:
+        lib = library.open_library(license_dir, pack_file)
+        lib_stamp = stamp
+    return lib
+
+def load_license(name, substitutions = None, keep = ()):
+    """Return the text of a named license.  It is only read if it has
+    changed since the last time.
+
+    substitutions: list of (field, value) pairs to fill in, earlier pairs
+      taking precedence over later ones; None to leave the text as is.
+    keep: fields to leave for later, such as those filled in for each
+      file; if the license has any of them, an objects.Template of it with
+      the rest filled in is returned instead of the text."""
+    with stats.phase("license"):
+        source = get_library()
+        stamp = source.stamp(name)
+        if stamp is None:
+            raise obj.RequestError("No license named '%s' found" % (name))
+        if name not in licenses or licenses[name][0] != stamp:
+            try:
+                text = source.read(name).rstrip("\n")
+            except (IOError, OSError):
+                raise obj.RequestError("No license named '%s' found"
+                                       % (name))
+            licenses[name] = (stamp, text, obj.Template(text))
+    stamp, text, template = licenses[name]
+    if substitutions is None:
+        return text
+    with stats.phase("substitution"):
+        values = {}
+        for old, new in substitutions:
+            values.setdefault(old, str(new))
+        if keep and not set(keep).isdisjoint(template.fields):
+            return template.partial(values, keep)
+        return template.render(values)
+
+def get_renderer(profile, explicit_settings):
+    """Return build_commentator(profile, explicit_settings), compiled, building
+    it only once."""
+    key = (profile, tuple(explicit_settings))
+    # the caches may be cleared by another thread at any time (see
+    # load_config), so nothing is looked up again once it's been stored
+    renderer = renderers.get(key)
+    if renderer is None:
+        renderer = build_commentator(profile, explicit_settings).compile()
+        renderers[key] = renderer
+    return renderer
+
+def get_box(profile, explicit_settings, license_text):
+    """Return the boxed license for a profile and settings, with the number
+    of lines to skip, the box's fingerprint and its frame (see
+    applier.find_box), building it only once."""
+    key = (profile, tuple(explicit_settings), license_text)
+    box = boxes.get(key)
+    if box is None:
+        with stats.phase("boxing"):
+            renderer = get_renderer(profile, explicit_settings)
+            boxed = renderer.render(license_text)
+            frame = (renderer.top, renderer.left_wall, renderer.bottom)
+            box = (boxed, renderer.skip_line, applier.fingerprint(boxed),
+                   frame)
+            boxes[key] = box
+    return box
+
+def get_header(profile, explicit_settings, template):
+    """Return the objects.Header for a license template (see load_license),
+    profile and settings, with the number of lines to skip and the box's
+    frame, building it only once."""
+    key = (profile, tuple(explicit_settings), tuple(template.literals),
+           tuple(template.fields))
+    header = headers.get(key)
+    if header is None:
+        with stats.phase("boxing"):
+            renderer = get_renderer(profile, explicit_settings)
+            frame = (renderer.top, renderer.left_wall, renderer.bottom)
+            header = (renderer.prepare(template), renderer.skip_line, frame)
+            headers[key] = header
+    return header
+
+def file_values(fullpath, cwd, file_year = False, mtime = None):
+    """Return the values of the fields filled in for each file: its
+    filename, its path relative to cwd, the module it would be imported as
+    from cwd (or just its name, less the suffix, if it's outside cwd) and,
+    if file_year is set, the year it was last modified in.
+
+    mtime: when the file was last modified, if it isn't on disk to ask."""
+    filename = os.path.basename(fullpath)
+    path = os.path.relpath(fullpath, cwd)
+    module = os.path.splitext(path)[0]
+    if module.startswith(os.pardir + os.sep):
+        module = os.path.splitext(filename)[0]
+    elif os.path.basename(module) == "__init__" and module != "__init__":
+        module = os.path.dirname(module)
+    values = {"filename": filename, "path": path,
+              "module": module.replace(os.sep, ".")}
+    if file_year:
+        try:
+            if mtime is None:
+                mtime = os.stat(fullpath).st_mtime
+            values["year"] = str(datetime.date.fromtimestamp(mtime).year)
+        except OSError:
+            # the file will fail to open too, and be reported then
+            pass
+    return values
+
+def suffix_profile(filename):
+    """Look up the profile associated with a file's suffix."""
+    suffix = os.path.splitext(filename)[1][1:]
+    try:
+        return config.get("suffixes", suffix)
+    except ConfigParser.NoOptionError:
+        raise obj.RequestError("Cannot intuit profile based on suffixes: no "
+                               "default set for suffix '%s'" % (suffix))
+
+def boxer(request):
+    """Load the license a request applies and return a function giving the
+    box for a file, from its path and optionally its modification time, as
+    (box, skip_line, fingerprint, frame) like get_box.  The fingerprint of a
+    box with fields filled in for each file is None unless the request skips
+    licensed files.  When no profile is named and no settings are given, each
+    file gets the profile its suffix maps to."""
+    if request["no_substitution"]:
+        license_text = load_license(request["license"])
+    else:
+        # fields given a value for the whole run are filled in as usual
+        given = set(field for field, value in request["substitute_value"])
+        keep = set(field for field in file_fields if field not in given)
+        if request["file_year"]:
+            keep.add("year")
+        license_text = load_license(request["license"],
+                                    request["substitute_value"], keep)
+    per_file = isinstance(license_text, obj.Template)
+    settings = [tuple(setting) for setting in request["settings"]]
+    profile = request["profile"]
+    by_suffix = not any([profile, settings, request["force_apply"]])
+    if by_suffix:
+        for filename in request["apply_to"]:
+            suffix_profile(filename)
+    def box_for(fullpath, mtime = None):
+        name = suffix_profile(fullpath) if by_suffix else profile
+        if not per_file:
+            return get_box(name, settings, license_text)
+        header, skip_line, frame = get_header(name, settings, license_text)
+        values = {}
+        if fullpath:
+            values = file_values(fullpath, request["cwd"],
+                                 request["file_year"], mtime)
+        boxed = header.render(values)
+        print_ = (applier.fingerprint(boxed) if request["skip_licensed"]
+                  else None)
+        return boxed, skip_line, print_, frame
+    return box_for
+
+def run_request(request, stats = None, jrnl = None, skip = ()):
+    """Carry out a request to apply licenses to files, check files for them
+    or update the licenses files already carry, generating (path, status,
+    detail) for each file as it's done.  The request is a dictionary holding
+    the relevant command line options; see make_request.
+
+    stats: timing.Stats to count the bytes read and written in.
+    jrnl: journal.Journal to record files rewritten in.
+    skip: paths to leave out, such as those done before a run was
+      interrupted."""
+    box_for = boxer(request)
+    paths = request_paths(request)
+    max_size = request["max_size"] if request["sniff"] else None
+    command = request["command"]
+    want_print = command == "check" or request["skip_licensed"]
+    def plan():
+        for fullpath in paths:
+            if fullpath in skip:
+                continue
+            boxed, skip_line, print_, frame = box_for(fullpath)
+            if command == "update":
+                yield (fullpath, boxed, skip_line, frame, stats, jrnl,
+                       max_size)
+            elif command == "apply":
+                yield (fullpath, boxed, skip_line,
+                       print_ if want_print else None, stats, jrnl, max_size)
+            else:
+                yield fullpath, boxed, skip_line, print_, stats, max_size
+    work = {"apply": applier.apply_license, "check": applier.check_license,
+            "update": applier.update_license}[command]
+    for task, status, detail in applier.run_pool(work, plan(),
+                                                 request["jobs"]):
+        yield task[0], status, detail
 
-config = ConfigParser.ConfigParser()
-config.read(config_file)
+def filter_request(request, name, fin, fout):
+    """Apply a request's license to source read from fin, writing the
+    licensed source to fout.  Returns what applier.filter_license does.
+
+    name: path the source would have, for the profile its suffix maps to
+      and the fields filled in for each file; None if it has none."""
+    if not name and not any([request["profile"], request["settings"],
+                             request["force_apply"]]):
+        raise obj.RequestError("Cannot intuit profile based on suffixes: "
+                               "the source has no name")
+    box_for = boxer(request)
+    boxed, skip_line, print_, frame = box_for(os.path.abspath(name)
+                                              if name else None)
+    max_size = request["max_size"] if request["sniff"] else None
+    return applier.filter_license(fin, fout, boxed, skip_line,
+                                  print_ if request["skip_licensed"] else None,
+                                  max_size)
+
+def archive_request(request, source, target):
+    """Copy the tar or zip archive at source to target, applying a
+    request's license to the files in it with known suffixes on the way (see
+    archive.rewrite), and generate (name, status, detail) for each of them,
+    like run_request."""
+    box_for = boxer(request)
+    suffixes = dict(config.items("suffixes"))
+    max_size = request["max_size"] if request["sniff"] else None
+    def pick(name):
+        return os.path.splitext(name)[1][1:] in suffixes
+    def clean(name, source, size, mtime, out):
+        boxed, skip_line, print_, frame = box_for(
+            os.path.join(request["cwd"], name), mtime)
+        return applier.filter_license(source, out, boxed, skip_line,
+                                      print_ if request["skip_licensed"]
+                                      else None, max_size, size)
+    import archive
+    return archive.rewrite(source, target, pick, clean, max_size)
+
+def git_filter_request(request, fin, fout):
+    """Act as git's filter process on fin and fout (see gitfilter),
+    applying a request's license to each file git checks in.  Files that
+    already carry it are passed through as they are, as are files whose
+    suffixes have no profile, so that cleaning a file twice changes
+    nothing."""
+    box_for = boxer(dict(request, skip_licensed = True))
+    max_size = request["max_size"] if request["sniff"] else None
+    def clean(pathname, source, size, out):
+        try:
+            boxed, skip_line, print_, frame = box_for(
+                os.path.join(request["cwd"], pathname))
+        except obj.RequestError:
+            shutil.copyfileobj(source, out, applier.copy_buffer)
+            return
+        status = applier.filter_license(source, out, boxed, skip_line,
+                                        print_, max_size, size)
+        stats.count("files_" + (status[0] if isinstance(status, tuple)
+                                else status))
+    import gitfilter
+    gitfilter.serve(fin, fout, clean, sys.stderr)
+
+def request_paths(request):
+    """Generate the paths of the files a request is about, as they're
+    found."""
+    suffixes = dict(config.items("suffixes"))
+    prune = walker.vendored_dirs + request["prune"]
+    sources = [request["apply_to"]]
+    sources += [walker.walk_tree(top, suffixes, prune, request["exclude_from"])
+                for top in request["recursive"]]
+    if request["git_staged"]:
+        sources.append(walker.git_changed(request["cwd"], suffixes))
+    if request["git_diff"]:
+        sources.append(walker.git_changed(request["cwd"], suffixes,
+                                          request["git_diff"]))
+    if request["paths_from"]:
+        sources.append(read_paths(request, suffixes))
+    return itertools.chain(*sources)
+
+def read_paths(request, suffixes):
+    """Generate the absolute paths listed in the file a request names in
+    paths_from ("-" for standard input), one per line or, if null is set,
+    separated by NULs.  They're read a chunk at a time, so there can be
+    any number of them.  As with --recursive, only those with suffixes in
+    suffixes are taken."""
+    source = request["paths_from"]
+    if source == "-":
+        fp = sys.stdin
+    else:
+        try:
+            fp = open(source, "rb")
+        except IOError as err:
+            raise obj.RequestError("Cannot read paths from %s: %s"
+                                   % (source, err.strerror))
+    try:
+        delimiter = "\0" if request["null"] else "\n"
+        for path in walker.split_stream(fp, delimiter):
+            suffix = os.path.splitext(path)[1][1:]
+            if path and suffix in suffixes:
+                yield os.path.join(request["cwd"], path)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+def identify_request(request, stats = None):
+    """Carry out a request to work out which license each file carries,
+    generating (path, status, detail) for each file as it's done, where
+    status is applier.OK with a detail of (license, score), or
+    applier.MISSING.  See run_request."""
+    import identify
+    index = identify.load_index(get_library(), identify_cache_file)
+    size = identify.scan_size(index)
+    tasks = ((fullpath, index, size, stats)
+             for fullpath in request_paths(request))
+    for task, status, detail in applier.run_pool(identify.identify_file,
+                                                 tasks, request["jobs"]):
+        yield task[0], status, detail
+
+def dispatch_request(request, stats = None, jrnl = None, skip = ()):
+    """Hand a request to whichever of run_request and identify_request
+    deals with it."""
+    if request["command"] == "identify":
+        return identify_request(request, stats)
+    return run_request(request, stats, jrnl, skip)
+
+def print_inventory(totals):
+    """Print how many files carry each license, directory by directory and
+    overall.
+
+    totals: directory -> {license name or None: number of files}."""
+    overall = {}
+    def describe(counts):
+        return ", ".join("%s %d" % (name or "unknown", counts[name])
+                         for name in sorted(counts))
+    for dirname in sorted(totals):
+        print "%s: %s" % (dirname, describe(totals[dirname]))
+        for name, count in totals[dirname].items():
+            overall[name] = overall.get(name, 0) + count
+    print "total: %s" % (describe(overall))
+
+def new_request(command, **options):
+    """Build a request for run_request (or identify_request), leaving every
+    option not given at its default.  Raises TypeError for options there's
+    no such thing as."""
+    request = {"command": command, "license": d_license, "profile": None,
+               "settings": [], "force_apply": False, "substitute_value": [],
+               "no_substitution": False, "apply_to": [], "recursive": [],
+               "exclude_from": [], "prune": [], "git_staged": False,
+               "git_diff": None, "cwd": os.getcwd(), "skip_licensed": False,
+               "sniff": True, "max_size": d_max_size, "file_year": False,
+               "paths_from": None, "null": False, "jobs": 1}
+    for option in options:
+        if option not in request:
+            raise TypeError("No request option named %s" % (option))
+    request.update(options)
+    return request
+
+def make_request(args, command):
+    """Build a request for run_request out of parsed command line options.
+    Paths are made absolute so that a daemon can make sense of them."""
+    abspaths = lambda paths: [os.path.abspath(path) for path in paths]
+    git = args.git_staged or args.git_diff
+    return new_request(command, license = args.license,
+                       profile = args.profile, settings = args.settings,
+                       force_apply = args.force_apply,
+                       substitute_value = args.substitute_value,
+                       no_substitution = args.no_substitution,
+                       file_year = args.file_year,
+                       apply_to = abspaths(args.apply_to),
+                       recursive = abspaths(args.recursive),
+                       exclude_from = abspaths(args.exclude_from),
+                       prune = args.prune, git_staged = args.git_staged,
+                       git_diff = args.git_diff,
+                       paths_from = (args.paths_from
+                                     if args.paths_from in (None, "-")
+                                     else os.path.abspath(args.paths_from)),
+                       null = args.null,
+                       skip_licensed = args.skip_licensed or bool(git),
+                       sniff = not args.no_sniff,
+                       max_size = (d_max_size if args.max_size is None
+                                   else args.max_size),
+                       jobs = args.jobs)
+
+def serve_request(request):
+    """run_request for the daemon, which first picks up any changes made to
+    the configuration file since it was read."""
+    ensure_config()
+    return dispatch_request(request)
+
+# The functions below make pycense usable as a library, by programs that
+# would rather not start a process for every batch of files.  They read the
+# configuration file as needed, never write it, and report problems by
+# raising objects.RequestError instead of exiting.
+
+# the outcome of a request for one file; see run_request
+Result = collections.namedtuple("Result", "path status detail")
+
+def substitutions(values = (), owner = None, company = None, year = None):
+    """Return the (field, value) pairs given followed by the owner, company
+    and year, which default to those in the configuration file and the
+    current year; see load_license."""
+    values = list(values)
+    values.append(("owner", owner if owner else d_owner))
+    values.append(("company", company if company else d_company))
+    values.append(("year", year if year else datetime.datetime.now().year))
+    return values
+
+def load_profile(name = None, settings = ()):
+    """Return the compiled commentator (an objects.Renderer) for a named
+    profile, or none, with settings, a list of (setting, value) pairs,
+    overriding its own.  Renderers are shared, so they can't be changed.
+    Raises objects.RequestError if there's no such profile."""
+    ensure_config()
+    return get_renderer(name, [tuple(setting) for setting in settings])
+
+def render_header(license = None, profile = None, settings = (), values = (),
+                  substitute = True, path = None):
+    """Return a license boxed as it would be applied to a file.
+
+    license: name of a license in the library; the default one if None.
+    profile, settings: see load_profile; if neither is given and path is,
+      the profile the path's suffix maps to.
+    values: (field, value) pairs to fill in, ahead of the default owner,
+      company and year and, if path is given, the path's own values (see
+      file_values).
+    substitute: False to leave <fields> in the license alone."""
+    ensure_config()
+    settings = [tuple(setting) for setting in settings]
+    if not profile and not settings and path:
+        profile = suffix_profile(path)
+    if path:
+        fullpath = os.path.abspath(path)
+        values = list(values) + file_values(fullpath, os.getcwd()).items()
+    license = license or d_license
+    if not license:
+        raise obj.RequestError("No license known or knowable.")
+    text = load_license(license, substitutions(values) if substitute else None)
+    return get_box(profile, settings, text)[0]
+
+def run_many(command, paths, license, profile, settings, values, substitute,
+             options):
+    """Carry out a request on a list of files, returning a Result for each.
+    See apply_many."""
+    ensure_config()
+    request = new_request(command, **options)
+    request["apply_to"] = [os.path.abspath(path) for path in paths]
+    request["recursive"] = [os.path.abspath(path)
+                            for path in request["recursive"]]
+    request["license"] = license or d_license
+    if command != "identify" and not request["license"]:
+        raise obj.RequestError("No license known or knowable.")
+    request["profile"] = profile
+    request["settings"] = [tuple(setting) for setting in settings]
+    request["no_substitution"] = not substitute
+    request["substitute_value"] = substitutions(values)
+    return [Result(*result) for result in dispatch_request(request)]
+
+def apply_many(paths, license = None, profile = None, settings = (),
+               values = (), substitute = True, **options):
+    """Apply a license to files, returning a Result for each, in the order
+    they were done, with a status of applier.OK, SKIPPED, EXCLUDED or ERROR.
+    Files already carrying the license are skipped if skip_licensed is set.
+
+    license, profile, settings, values, substitute: see render_header;
+      without a profile or settings, each file gets the profile its suffix
+      maps to.
+    options: any other request option (see new_request), such as jobs,
+      skip_licensed, max_size, sniff or recursive."""
+    return run_many("apply", paths, license, profile, settings, values,
+                    substitute, options)
+
+def check_many(paths, license = None, profile = None, settings = (),
+               values = (), substitute = True, **options):
+    """Check whether files carry a license, returning a Result for each,
+    with a status of applier.OK, MISSING, EXCLUDED or ERROR.  See
+    apply_many."""
+    return run_many("check", paths, license, profile, settings, values,
+                    substitute, options)
+
+def update_many(paths, license = None, profile = None, settings = (),
+                values = (), substitute = True, **options):
+    """Replace the licenses files carry with the current one, returning a
+    Result for each, with a status of applier.OK, SKIPPED, MISSING,
+    EXCLUDED or ERROR.  See apply_many."""
+    return run_many("update", paths, license, profile, settings, values,
+                    substitute, options)
+
+def identify_many(paths, **options):
+    """Work out which license from the library each file carries, returning
+    a Result for each, with a status of applier.OK and a detail of
+    (license, score), or applier.MISSING.  See apply_many."""
+    return run_many("identify", paths, None, None, (), (), False, options)
 
-d_license = config.get("defaults", "license")
-d_company = config.get("defaults", "company")
-d_owner = config.get("defaults", "owner")
-d_editor = config.get("defaults", "editor")
-d_settings = {("tab", config.getint("defaults", "tab")),
-              ("width", config.getint("defaults", "width")),
-              ("skip_line", config.getint("defaults", "skip_line"))}
 default_key = {"l": "license", "c": "company", "o": "owner", "t": "tab", 
-               "w": "width", "mn": "magic_number", "e": "editor"}
+               "w": "width", "mn": "magic_number", "e": "editor",
+               "ms": "max_size"}
 seeables = ["all", "defaults", "profiles", "licenses", "sample", "suffixes"]
 
 parser = argparse.ArgumentParser(prog = __prog__,
@@ -72,7 +648,6 @@ parser = argparse.ArgumentParser(prog = __prog__,
                                      ("A friendly and modifiable program for "
                                       "slipping copyright notices into your "
                                       "source code."))
-setattr(parser, "d_settings", d_settings)
 setattr(parser, "default_key", default_key)
 setattr(parser, "seeables", seeables)
 
@@ -89,8 +664,7 @@ parser.add_argument("--profile", "-p", type = str,
                     help = "the comment style profile to load")
 parser.add_argument("--license", "-l", type = str, 
                     action = obj.LicenseTypeAction, dest = "license",
-                    help = ("license to load; default is %s"
-                            % d_license))
+                    help = ("license to load; default is %(default)s"))
 parser.add_argument("--force_apply", "-fa", action = "store_true", 
                     default = False,
                     help = ("apply license to files even if no profile "
@@ -180,15 +754,24 @@ parser.add_argument("--rename_license", "-rl", type = str, nargs = "+",
 parser.add_argument("--remove_license", "-rml", type = str, nargs = "+",
                     metavar = "LICENSE", default = [],
                     help = "remove these licenses from the library")
+parser.add_argument("--pack_licenses", action = "store_true",
+                    default = False,
+                    help = ("pack the license library into a single indexed "
+                            "file, which is quicker to use when there are "
+                            "many licenses or the storage is slow"))
+parser.add_argument("--unpack_licenses", action = "store_true",
+                    default = False,
+                    help = ("turn a packed license library back into a "
+                            "directory of files"))
 parser.add_argument("--edit_license", "-el", type = str, nargs = "+",
                     default = [], metavar = "LICENSE",
                     help = ("open up a license by name to edit using the "
                             "editor specified on the command line or in the "
                             "defaults; note that imports and renames are "
                             "performed before editing"))
-parser.add_argument("--editor", "-e", type = str, default = d_editor,
+parser.add_argument("--editor", "-e", type = str,
                     help = ("editor to use for editing the license this time; "
-                            "%s by defaults" % d_editor))
+                            "%(default)s by default"))
 
 # setting defaults
 parser.add_argument("--default_license", "-dl", type = str,
@@ -218,6 +801,11 @@ parser.add_argument("--default_editor", "-de", type = str,
                     action = obj.DefaultAction, dest = "defaults",
                     help = ("text editor to use when opening licenses to "
                             "edit."))
+parser.add_argument("--default_max_size", "-dms", type = int,
+                    metavar = "BYTES", action = obj.DefaultAction,
+                    dest = "defaults", default = [],
+                    help = ("set the size of the largest file to apply "
+                            "licenses to; 0 for no limit"))
 parser.add_argument("--default_suffix", "-ds", type = str, nargs = "+",
                     action = obj.AddSuffix, dest = "add_suffix",
                     default = [], metavar = "SUFFIX PROFILE",
@@ -239,6 +827,10 @@ parser.add_argument("--owner", "-o", type = str,
 parser.add_argument("--substitute_value", "-sv", type = str, nargs = '+', 
                     default = [], action = obj.ValueAdded, metavar = "OLD NEW",
                     help = ("replace <OLD> with NEW once"))
+parser.add_argument("--file_year", "-fy", action = "store_true",
+                    default = False,
+                    help = ("replace <year> with the year each file was last "
+                            "modified instead"))
 parser.add_argument("--no_substitution", "-ns", action = "store_true",
                     default = False, 
                     help = ("don't perform any substitutions of "
@@ -249,6 +841,122 @@ parser.add_argument("--apply_to", "-a", type = str, nargs = "+",
                     metavar = "SOURCE", default = [],
                     help = ("a list of source files to apply the current "
                             "settings to"))
+parser.add_argument("--recursive", "-r", type = str, nargs = "+",
+                    metavar = "DIR", default = [],
+                    help = ("search these directories for source files with "
+                            "known suffixes and apply the current settings to "
+                            "them as they are found; without a profile, each "
+                            "file gets the profile its suffix maps to"))
+parser.add_argument("--exclude_from", "-x", type = str, nargs = "+",
+                    metavar = "FILE", default = [],
+                    help = ("gitignore-style files listing paths for "
+                            "--recursive to leave alone; .gitignore files "
+                            "found along the way are always honored"))
+parser.add_argument("--paths_from", type = str, metavar = "FILE",
+                    help = ("apply the current settings to the files with "
+                            "known suffixes listed in FILE, one per line, "
+                            "as they're read; - for standard input"))
+parser.add_argument("--null", "-0", action = "store_true", default = False,
+                    help = ("paths given with --paths_from are separated by "
+                            "NULs, as find -print0 and git ls-files -z "
+                            "write them, rather than by newlines"))
+parser.add_argument("--filter", type = str, nargs = "?", const = "",
+                    metavar = "NAME",
+                    help = ("apply the license to source read from standard "
+                            "input and write the result to standard output; "
+                            "NAME is the file it would be, for its suffix's "
+                            "profile and per-file fields"))
+parser.add_argument("--archive", type = str, nargs = 2,
+                    metavar = ("SOURCE", "TARGET"),
+                    help = ("apply the current settings to the files with "
+                            "known suffixes inside the tar (.tar, .tar.gz, "
+                            ".tar.bz2, .tar.xz) or zip archive SOURCE, "
+                            "writing the result to the new archive TARGET; "
+                            "nothing is unpacked to disk"))
+parser.add_argument("--git_filter", action = "store_true", default = False,
+                    help = ("act as a git filter process, licensing files as "
+                            "they're checked in; set filter.pycense.process "
+                            "to pycense --git_filter and give files "
+                            "filter=pycense in .gitattributes"))
+parser.add_argument("--prune", type = str, nargs = "+", metavar = "DIR_NAME",
+                    default = [],
+                    help = ("names of directories for --recursive to skip in "
+                            "addition to the usual vendored directories (%s)"
+                            % ", ".join(walker.vendored_dirs)))
+parser.add_argument("--check", "-ck", action = "store_true", default = False,
+                    help = ("instead of applying the license, list the files "
+                            "that don't already carry it and exit with an "
+                            "error if there are any; nothing is written"))
+parser.add_argument("--update", "-u", action = "store_true", default = False,
+                    help = ("instead of applying the license, replace the "
+                            "license files already carry with the current "
+                            "one, such as to bump the year or change the "
+                            "owner; the old box must be drawn with the same "
+                            "settings, and files already up to date aren't "
+                            "touched"))
+parser.add_argument("--identify", "-id", action = "store_true",
+                    default = False,
+                    help = ("instead of applying the license, report which "
+                            "license from the library, if any, each file "
+                            "already carries"))
+parser.add_argument("--inventory", "-inv", action = "store_true",
+                    default = False,
+                    help = ("like --identify, but report how many files "
+                            "carry each license, directory by directory"))
+parser.add_argument("--skip_licensed", "-sk", action = "store_true",
+                    default = False,
+                    help = ("leave files alone if they already begin with the "
+                            "license as it would be applied, give or take the "
+                            "year"))
+parser.add_argument("--git_staged", "-gs", action = "store_true",
+                    default = False,
+                    help = ("apply the current settings to files with known "
+                            "suffixes staged for the next git commit; files "
+                            "already licensed are left alone"))
+parser.add_argument("--git_diff", "-gd", type = str, metavar = "REV",
+                    help = ("apply the current settings to files with known "
+                            "suffixes that differ from git revision REV; "
+                            "files already licensed are left alone"))
+parser.add_argument("--max_size", type = int, metavar = "BYTES",
+                    help = ("leave files larger than this alone; 0 for no "
+                            "limit; default is %(default)s"))
+parser.add_argument("--no_sniff", action = "store_true", default = False,
+                    help = ("don't look for binary, generated or oversized "
+                            "files to leave alone; trust the suffixes"))
+parser.add_argument("--jobs", "-j", type = int, default = 1, metavar = "N",
+                    help = ("number of files to work on at once; raising this "
+                            "helps most on slow or networked storage"))
+parser.add_argument("--journal", action = "store_true", default = False,
+                    help = ("keep a journal of the files rewritten, along "
+                            "with their originals, so that the run can be "
+                            "finished with --resume or undone with "
+                            "--rollback if it's interrupted"))
+parser.add_argument("--resume", action = "store_true", default = False,
+                    help = ("finish the interrupted run recorded in the "
+                            "journal"))
+parser.add_argument("--rollback", action = "store_true", default = False,
+                    help = ("undo the interrupted run recorded in the "
+                            "journal, restoring every file it rewrote"))
+parser.add_argument("--serve", action = "store_true", default = False,
+                    help = ("run as a daemon, keeping profiles, licenses and "
+                            "boxes in memory and taking work from --client "
+                            "invocations of pycense"))
+parser.add_argument("--client", action = "store_true", default = False,
+                    help = ("hand the work of applying licenses to a "
+                            "running pycense --serve, or do it here if there "
+                            "isn't one"))
+parser.add_argument("--socket", type = str, default = socket_file,
+                    metavar = "PATH",
+                    help = ("socket the daemon listens on; %s by default"
+                            % (socket_file)))
+parser.add_argument("--stats", action = "store_true", default = False,
+                    help = ("when done, write the time spent in each phase of "
+                            "the run and counts of the files and bytes "
+                            "handled to standard error as JSON"))
+parser.add_argument("--profile_run", type = str, metavar = "FILE",
+                    help = ("profile the run with cProfile and save the "
+                            "results in FILE; where tracemalloc is available, "
+                            "peak traced memory is added to --stats"))
 parser.add_argument("--see", "-s", type = str, action = obj.SeeSomeAction,
                     nargs = "+", metavar = "SEEABLE", dest = "must_see",
                     default = [],
@@ -257,7 +965,12 @@ parser.add_argument("--see", "-s", type = str, action = obj.SeeSomeAction,
                             "sample will print a boxed license to your "
                             "terminal screen"))
 
-if __name__ == "__main__":
+def main():
+    """Run pycense from the command line.  Exits rather than returning."""
+    global show_stats, profiler, profile_file
+    ensure_config()
+    parser.set_defaults(license = d_license, editor = d_editor,
+                        max_size = d_max_size)
     args = parser.parse_args()
     def unescape(obj):
         """Filters out escape sequences protecting non-option arguments that
@@ -277,6 +990,15 @@ if __name__ == "__main__":
                     r_unescape(getattr(obj, field)))
     unescape(args)
 
+    show_stats = args.stats
+    if args.profile_run:
+        import cProfile
+        profile_file = args.profile_run
+        if tracemalloc:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     if len(sys.argv) == 1:
         parser.print_usage()
         print "You leave me with no option."
@@ -289,12 +1011,8 @@ if __name__ == "__main__":
         terminate(0)
     # remove stuff
     for toremove in args.remove_license:
-        try:
-            os.remove(name_to_path(toremove))
-        except OSError as err:
-            if err.errno == 2:
-                # fail silently unless --silent, --verbose  support added
-                pass
+        # fail silently unless --silent, --verbose  support added
+        get_library().remove(toremove)
     for toremove in args.remove_profile:
         try:
             assert config.remove_option("profiles", toremove) == True
@@ -306,18 +1024,22 @@ if __name__ == "__main__":
 
     # import and rename stuff
     for filepath, newname in args.imports:
-        shutil.copy(filepath, name_to_path(newname))
+        with open(filepath, "r") as fp:
+            get_library().add(newname, fp.read())
     for old, new in args.rename_profile:
         olddata = config.get("profiles", old)
         if olddata:
             config.set("profiles", new, config.get("profiles", old))
             config.remove_option("profiles", old)
     for old, new in args.rename_license:
-        try:
-            os.rename(name_to_path(old), name_to_path(new))
-        except OSError as err:
-            if err.errno == 2:
-                pass
+        get_library().rename(old, new)
+    if args.pack_licenses:
+        library.pack(license_dir, pack_file)
+    if args.unpack_licenses:
+        if not os.path.exists(pack_file):
+            print "The license library isn't packed."
+            terminate(1)
+        library.unpack(pack_file, license_dir)
 
     # adjust defaults
     for name, value in args.defaults:
@@ -327,96 +1049,106 @@ if __name__ == "__main__":
 
     # edit licenses
     for license_file in args.edit_license:
-        path = name_to_path(license_file)
+        source = get_library()
         if not args.editor:
             print "No editor designated"
             terminate(1)
-        if os.path.exists(path):
-            os.system("%s %s" % (args.editor, path))
-        else:
+        if source.stamp(license_file) is None:
             print "No license named %s found." % (license_file)
             terminate(1)
+        path = source.file_path(license_file)
+        if path:
+            os.system("%s %s" % (args.editor, path))
+            continue
+        # packed licenses are edited in a scratch file and packed again
+        scratch = tempfile.mkdtemp(prefix = "pycense")
+        try:
+            path = os.path.join(scratch, license_file + ".txt")
+            text = source.read(license_file)
+            with open(path, "w") as fp:
+                fp.write(text)
+            os.system("%s %s" % (args.editor, path))
+            with open(path, "r") as fp:
+                edited = fp.read()
+            if edited != text:
+                source.add(license_file, edited)
+        finally:
+            shutil.rmtree(scratch)
+
+    # run as a daemon if desired
+    if args.serve:
+        import daemon
+        try:
+            daemon.serve(args.socket, serve_request)
+        except obj.RequestError as err:
+            print err
+            terminate(1)
+        terminate(0)
+
+    # undo an interrupted run
+    if args.rollback:
+        import journal
+        try:
+            restored = journal.rollback(journal_file)
+        except obj.RequestError as err:
+            print err
+            terminate(1)
+        print "Restored %d files" % (restored)
+        terminate(0)
 
     # load license if needed
-    if args.apply_to or "sample" in args.must_see:
-        # load license
+    selected = any([args.apply_to, args.recursive, args.git_staged,
+                    args.git_diff, args.paths_from, args.filter is not None,
+                    args.git_filter, args.archive])
+    identifying = args.identify or args.inventory
+    must_apply = selected and not identifying
+    if must_apply or "sample" in args.must_see:
         if not args.license:
             args.license = d_license
-        if args.license:
-            license_file = name_to_path(args.license)
-            try:
-                license_text = open(license_file, "r").read().rstrip("\n")
-            except:
-                print "No license named '%s' found" % (args.license)
-                terminate(1)
-        else:
+        if not args.license:
             print "No license known or knowable."
             terminate(1)
         if not args.no_substitution:
             # swap in replacements in the text
-            args.substitute_value.append(("owner", args.owner if args.owner 
-                                            else d_owner))
-            args.substitute_value.append(("company", 
-                                args.company if args.company else d_company))
-            args.substitute_value.append(("year", 
-                               args.year if args.year else 
-                               datetime.datetime.now().year))
-            # an even number of backslashes doesn't affect substitution
-            pieces = license_text.split("\\\\")
-            for old, new in args.substitute_value:
-                # make all substitutions unless brocket preceded by a backslash
-                pieces = [re.sub(r"(?<!\\)<%s>" % old, str(new), piece) 
-                          for piece in pieces]
-            pieces = [re.sub(r"\\(?P<brocketed>\<.*?\>)", "\g<brocketed>", piece)
-                      for piece in pieces]
-            # replace doubled backslashes, throughing first of every pair away
-            license_text = "\\".join(pieces)
+            args.substitute_value = substitutions(args.substitute_value,
+                                                  args.owner, args.company,
+                                                  args.year)
+    if "sample" in args.must_see:
+        try:
+            license_text = load_license(args.license, None
+                                        if args.no_substitution
+                                        else args.substitute_value)
+        except obj.RequestError as err:
+            print err
+            terminate(1)
 
     # load profile if needed
     must_store = args.store_as or args.store_in_place
-    if args.apply_to or "sample" in args.must_see or must_store:
-        if not args.profile and not args.settings and not args.force_apply:
-            # try for default profile: all suffixes must map to the same profile
-            d_profile = None
-            for filename in args.apply_to:
-                suffix = os.path.splitext(filename)[1][1:]
-                try:
-                    c_profile = config.get("suffixes", suffix)
-                    if not d_profile:
-                        d_profile = c_profile
-                    elif d_profile != c_profile:
-                        print ("Cannot intuit profile based on suffixes: "
-                               "conflcting default for %s" % (suffix))
-                        terminate(1)
-                except ConfigParser.NoOptionError:
-                    print ("Cannot intuit profile based on suffixes: no default "
-                           "set for suffix '%s'" % (suffix))
-                    terminate(1)
-            args.profile = d_profile
-
-        # create Commentator
-        if args.profile:
-            # load settings from named profile
+    loaded_profile = args.profile
+    if must_apply or "sample" in args.must_see or must_store:
+        if not any([args.profile, args.settings, args.force_apply]):
+            # every file gets the profile its suffix maps to, so every
+            # suffix needs one; if they all agree, that's the profile loaded
             try:
-                settings = eval(config.get("profiles", str(args.profile)))
-            except ConfigParser.NoOptionError:
-                print "No settings profile named %s" % (args.profile)
+                profiles = set(suffix_profile(filename)
+                               for filename in args.apply_to)
+            except obj.RequestError as err:
+                print err
                 terminate(1)
-        else:
-            settings = []
-        for setting, value in args.settings:
-            # swap in any settings explicitly set in the cmdline
-            settings.append((setting, value))
-        for setting, value in d_settings:
-            # only swap in default settings if not set elsewhere
-            if setting not in [t[0] for t in settings]:
-                settings.append((setting, value))
-        com = obj.Commentator(settings)
+            if len(profiles) == 1:
+                loaded_profile = profiles.pop()
+
+        # create Commentator
+        try:
+            com = build_commentator(loaded_profile, args.settings)
+        except obj.RequestError as err:
+            print err
+            terminate(1)
 
     # manage named profiles
     if args.store_in_place:
-        if args.profile:
-            config.set("profiles", args.profile, com.get_storage())
+        if loaded_profile:
+            config.set("profiles", loaded_profile, com.get_storage())
         else:
             print "Can't store in place because no named profile specified."
             terminate(1)
@@ -431,13 +1163,14 @@ if __name__ == "__main__":
         for var, val in sorted(config.items("suffixes")):
             print "suffix %s: %s" % (var, val)
     if "licenses" in args.must_see:
-        for filename in os.listdir(cwd + "licenses"):
-            print "license: %s" % (filename)
+        for name in get_library().names():
+            print "license: %s" % (name)
     if "profiles" in args.must_see:
-        for var, val in sorted(config.items("profiles")):
+        for var in sorted(config.options("profiles")):
             print "profile: %s" % (var)
             # get rid of braces
-            dicstr = pprint.pformat(eval(val)).replace("{", " ")[:-1]
+            dicstr = pprint.pformat(config.get_profile(var))
+            dicstr = dicstr.replace("{", " ")[:-1]
             for line in dicstr.split("\n"):
                 # get rid of single quotes around the data member names
                 line = line.replace("'", "", 2)
@@ -446,31 +1179,146 @@ if __name__ == "__main__":
     if "sample" in args.must_see:
         print com.get_boxed(license_text)
 
+    # license standard input
+    if args.filter is not None:
+        if args.check or args.update or identifying or args.journal:
+            sys.stderr.write("--filter can only apply licenses\n")
+            terminate(1)
+        if args.paths_from == "-":
+            sys.stderr.write("--filter and --paths_from can't both read "
+                             "standard input\n")
+            terminate(1)
+        request = make_request(args, "apply")
+        try:
+            with stats.phase("files"):
+                status = filter_request(request, args.filter, sys.stdin,
+                                        sys.stdout)
+        except (obj.RequestError, IOError, OSError) as err:
+            sys.stderr.write("%s\n" % (err))
+            terminate(1)
+        if isinstance(status, tuple):
+            sys.stderr.write("Passed through unchanged: %s\n" % (status[1]))
+        terminate(0)
+
+    # license files as git checks them in
+    if args.git_filter:
+        request = make_request(args, "apply")
+        try:
+            with stats.phase("files"):
+                git_filter_request(request, sys.stdin, sys.stdout)
+        except (obj.RequestError, IOError, OSError) as err:
+            sys.stderr.write("%s\n" % (err))
+            terminate(1)
+        terminate(0)
+
     # modify the files
-    if any([args.profile, args.settings, args.force_apply]):
-        for fullpath in args.apply_to:
-            dirname = os.path.dirname(os.path.abspath(fullpath)) + os.sep
-            filename = os.path.basename(fullpath)
-            mode = stat.S_IMODE(os.stat(fullpath).st_mode)
-            fin = open(fullpath, "r")
-            fout = tempfile.NamedTemporaryFile(prefix = "tmp%s" % filename, 
-                                               dir = dirname, suffix = "txt", 
-                                               delete = False)
-            os.chmod(fout.name, mode)
-            for i in range(com.skip_line):
-                line = fin.readline()
-                fout.write(line)
-            fout.write(com.get_boxed(license_text) + "\n")
-            for line in fin.readlines():
-                fout.write(line)
-            fout.flush()
-            os.rename(fout.name, fullpath)
-            fout.close
-    else:
-        if args.apply_to:
-            print ("To write to a file, you must either specify a comment "
-                   "profile, explicitly set some commenting settings, or use "
-                   "the flag --force_apply")
+    request = None
+    if args.resume:
+        import journal
+        try:
+            request, carried = journal.recover(journal_file)
+        except obj.RequestError as err:
+            print err
+            terminate(1)
+        if not request:
+            print "The run recorded in %s had already finished" % (
+                journal_file)
+    elif args.archive:
+        if args.check or args.update or identifying or args.journal:
+            print "--archive can only apply licenses"
+            terminate(1)
+        if any([args.apply_to, args.recursive, args.git_staged,
+                args.git_diff, args.paths_from]):
+            print "--archive works on the archive alone"
+            terminate(1)
+        request = make_request(args, "apply")
+    elif selected:
+        if identifying:
+            request = make_request(args, "identify")
+        elif args.check:
+            request = make_request(args, "check")
+        elif args.update:
+            request = make_request(args, "update")
+        else:
+            request = make_request(args, "apply")
+    if request:
+        command = request["command"]
+        jrnl = None
+        failed = False
+        # license -> number of files, by directory
+        totals = {}
+        try:
+            if args.archive:
+                results = archive_request(request, *args.archive)
+            elif args.resume:
+                jrnl = journal.Journal(journal_file, request, carried, True)
+                skip = set(record["path"] for record in carried)
+                results = run_request(request, stats, jrnl, skip)
+            elif args.journal and command not in ["check", "identify"]:
+                # only runs that write files have anything to journal
+                import journal
+                jrnl = journal.Journal(journal_file, request)
+                results = run_request(request, stats, jrnl)
+            else:
+                # the daemon can't read our standard input
+                remote = args.client and request["paths_from"] != "-"
+                conn = None
+                if remote:
+                    import daemon
+                    conn = daemon.connect(args.socket)
+                if conn:
+                    results = daemon.exchange(conn, request)
+                else:
+                    results = dispatch_request(request, stats)
+            with stats.phase("files"):
+                for fullpath, status, detail in results:
+                    stats.count("files_" + status)
+                    if command == "identify" and status != applier.ERROR:
+                        name = detail[0] if status == applier.OK else None
+                        if args.identify and name:
+                            print "%s: %s (%d%%)" % (fullpath, name,
+                                                     100 * detail[1])
+                        elif args.identify:
+                            print "%s: unknown" % (fullpath)
+                        counts = totals.setdefault(os.path.dirname(fullpath),
+                                                   {})
+                        counts[name] = counts.get(name, 0) + 1
+                    elif status == applier.EXCLUDED:
+                        print "Skipped %s: %s" % (fullpath, detail)
+                    elif status == applier.MISSING and command == "update":
+                        print "No license to update in %s" % (fullpath)
+                        failed = True
+                    elif status == applier.MISSING:
+                        print fullpath
+                        failed = True
+                    elif status == applier.ERROR:
+                        if command == "check":
+                            print "Could not check %s: %s" % (fullpath,
+                                                              detail)
+                        elif command == "identify":
+                            print "Could not identify %s: %s" % (fullpath,
+                                                                 detail)
+                        elif command == "update":
+                            print "Could not update %s: %s" % (fullpath,
+                                                               detail)
+                        else:
+                            print "Could not apply license to %s: %s" % (
+                                fullpath, detail)
+                        failed = True
+            if jrnl:
+                jrnl.finish()
+            if args.inventory:
+                print_inventory(totals)
+        except obj.RequestError as err:
+            print err
+            if jrnl:
+                print ("Finish the run with --resume or undo it with "
+                       "--rollback")
+            terminate(1)
+        if failed:
             terminate(1)
 
     terminate(0)
+
+if __name__ == "__main__":
+    main()
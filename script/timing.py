@@ -0,0 +1,110 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+"""Bookkeeping for --stats: time spent in each phase of a run and counts of
+the work done."""
+
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    # processor time used by this process, on Unix
+    cpu_time = time.clock
+
+class Stats:
+    """Accumulates wall and CPU time per named phase, and named counters.
+
+    Phases may nest; time spent in an inner phase is charged to it alone,
+    not to the phase surrounding it.  Phases and counters may be entered
+    from any thread; each thread's phases nest separately."""
+
+    def __init__(self):
+        self.phases = {}
+        self.order = []
+        self.counters = {}
+        self.lock = threading.Lock()
+        # each thread's stack of (phase, wall, cpu) for the phases it's in
+        self.local = threading.local()
+
+    def thread_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def charge(self, name, wall, cpu):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = [0.0, 0.0]
+                self.order.append(name)
+            self.phases[name][0] += wall
+            self.phases[name][1] += cpu
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as part of phase name."""
+        stack = self.thread_stack()
+        now = (time.time(), cpu_time())
+        if stack:
+            # pause whatever this interrupts
+            outer, wall, cpu = stack[-1]
+            self.charge(outer, now[0] - wall, now[1] - cpu)
+        stack.append((name,) + now)
+        try:
+            yield
+        finally:
+            name, wall, cpu = stack.pop()
+            now = (time.time(), cpu_time())
+            self.charge(name, now[0] - wall, now[1] - cpu)
+            if stack:
+                # resume it
+                stack[-1] = (stack[-1][0],) + now
+
+    def count(self, name, n = 1):
+        """Add n to counter name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        """Summarize everything recorded so far as a dictionary."""
+        with self.lock:
+            report = {"phases": [{"phase": name,
+                                  "wall": round(self.phases[name][0], 6),
+                                  "cpu": round(self.phases[name][1], 6)}
+                                 for name in self.order],
+                      "counters": dict(self.counters)}
+        if resource:
+            # kilobytes on Linux, bytes on some other systems
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            report["max_rss"] = usage.ru_maxrss
+        return report
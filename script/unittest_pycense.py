@@ -22,7 +22,27 @@
 ###############################################################################
 
 import unittest
+import os
+import sys
+import shutil
+import tempfile
+import tarfile
+import zipfile
+import StringIO
+import textwrap
 import objects
+import walker
+import applier
+import configstore
+import daemon
+import journal
+import library
+import identify
+import gitfilter
+import archive
+import pycense
+import threading
+import timing
 
 class TestSequenceFunctions(unittest.TestCase):
     def setUp(self):
@@ -127,5 +147,989 @@ class TestSequenceFunctions(unittest.TestCase):
         should_width = 3
         self.assertEqual(self.com.width, should_width)
 
+class TestTemplate(unittest.TestCase):
+    def test_substitution(self):
+        """Known fields are filled in, unknown ones left alone."""
+        t = objects.Template("(c) <year> <owner>, <unknown>")
+        should = "(c) 2013 Me, <unknown>"
+        self.assertEqual(t.render({"year": "2013", "owner": "Me"}), should)
+
+    def test_escapes(self):
+        """An odd number of backslashes protects a field, and doubled
+        backslashes are halved."""
+        t = objects.Template(r"\<owner> \\<owner> \\\<owner> a\b")
+        should = r"<owner> \Me \<owner> a\b"
+        self.assertEqual(t.render({"owner": "Me"}), should)
+
+    def test_reuse(self):
+        """One template renders with many sets of values."""
+        t = objects.Template("<a><b>\n\n<a>")
+        self.assertEqual(t.render({"a": "1", "b": "2"}), "12\n\n1")
+        self.assertEqual(t.render({"a": "x"}), "x<b>\n\nx")
+        self.assertEqual(t.render({"a": "<b>", "b": "2"}), "<b>2\n\n<b>")
+
+    def test_partial(self):
+        """Filling in all but some fields leaves a template of the rest,
+        escaped brockets staying literal."""
+        t = objects.Template(r"<a> \<b> <b> <c>")
+        rest = t.partial({"a": "1", "b": "<b>"}, set(["b"]))
+        self.assertEqual(rest.fields, ["b"])
+        self.assertEqual(rest.render({"b": "2"}), "1 <b> 2 <c>")
+
+class TestWrap(unittest.TestCase):
+    def test_matches_textwrap(self):
+        """wrap gives the same lines as textwrap.wrap, hyphens, runs of
+        whitespace and overlong words included."""
+        texts = ["", "   ", "  lead and trail  ", "a\tb\nc\x0bd",
+                 "well-known self-evident --option x--y 2-3 a-",
+                 "x" * 30 + " short " + "-" * 12 + " y" * 9,
+                 open("licenses/mit_license.txt").read()]
+        for text in texts:
+            for width in [1, 2, 5, 9, 40, 79]:
+                self.assertEqual(objects.wrap(text, width),
+                                 textwrap.wrap(text, width))
+
+    def test_layout_reused(self):
+        """A paragraph seen before at the same width isn't wrapped again."""
+        objects.layouts.clear()
+        com = objects.Commentator([("left_wall", "# "), ("width", 20)])
+        com.get_boxed("one two three four\n\nfive six")
+        self.assertEqual(len(objects.layouts), 2)
+        objects.layouts[("five six", 18)] = ("cached",)
+        boxed = com.get_boxed("seven\n\nfive six")
+        self.assertEqual([line.rstrip() for line in boxed.split("\n")],
+                         ["# seven", "#", "# cached"])
+        objects.layouts.clear()
+
+class TestRenderer(unittest.TestCase):
+    def setUp(self):
+        self.com = objects.Commentator([("top_begin", "/*"), ("top_fill", "*"),
+                                        ("left_wall", " * "),
+                                        ("right_wall", " *"),
+                                        ("bottom_begin", " "),
+                                        ("bottom_fill", "*"),
+                                        ("bottom_end", "*/"), ("width", 24)])
+
+    def test_frozen(self):
+        """A compiled renderer draws the box it was compiled for, whatever
+        happens to the commentator afterwards, and can't be changed."""
+        renderer = self.com.compile()
+        text = "Some\ttext that wraps.\n\nAnd more.\n"
+        boxed = self.com.get_boxed(text)
+        self.com.set_value("width", 40)
+        self.assertEqual(renderer.render(text), boxed)
+        self.assertEqual(boxed.split("\n")[0], "/*" + "*" * 22)
+        self.assertEqual(boxed.split("\n")[3], " *" + " " * 20 + " *")
+        self.assertEqual(renderer.text_width, 19)
+        self.assertRaises(AttributeError, setattr, renderer, "width", 40)
+
+    def test_header(self):
+        """A prepared header renders just like the whole license, however
+        the values change the paragraphs they fall in."""
+        renderer = self.com.compile()
+        template = objects.Template("(c) <year>\n\nAbout <f>, which is "
+                                    "a file.\n\nStatic <g>\n\n<f>")
+        header = renderer.prepare(template.partial({"year": "2013"},
+                                                   set(["f", "g"])))
+        for f, g in [("a.py", "x"), ("a much longer name than that", ""),
+                     ("", "two\n\nparagraphs"), ("\n", "y\n")]:
+            values = {"year": "2013", "f": f, "g": g}
+            self.assertEqual(header.render(values),
+                             renderer.render(template.render(values)))
+
+class TestWalker(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def touch(self, relpath, text = "x\n"):
+        path = os.path.join(self.top, *relpath.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fp:
+            fp.write(text)
+
+    def found(self, **kwargs):
+        paths = walker.walk_tree(self.top, ["py", "c"], **kwargs)
+        return sorted(os.path.relpath(p, self.top).replace(os.sep, "/")
+                      for p in paths)
+
+    def test_ignore_rules(self):
+        """Check anchoring, directory-only patterns and negation."""
+        rules = walker.IgnoreRules(["# comment", "*.c", "!keep.c", "/build",
+                                    "gen/", "docs/**/*.py"])
+        self.assertTrue(rules.match("a/b.c", False))
+        self.assertFalse(rules.match("a/keep.c", False))
+        self.assertTrue(rules.match("build", True))
+        self.assertEqual(rules.match("a/build", True), None)
+        self.assertTrue(rules.match("a/gen", True))
+        self.assertEqual(rules.match("a/gen", False), None)
+        self.assertTrue(rules.match("docs/x/y/z.py", False))
+        self.assertEqual(rules.match("src/z.py", False), None)
+
+    def test_walk_filters_and_prunes(self):
+        """Only files with listed suffixes are found, and vendored or
+        ignored directories are skipped."""
+        for relpath in ["a.py", "b.txt", "sub/c.c", "node_modules/d.py",
+                        "sub/gen/e.py", "sub/f.py"]:
+            self.touch(relpath)
+        self.touch("sub/.gitignore", "gen/\nf.py\n")
+        self.assertEqual(self.found(), ["a.py", "sub/c.c"])
+
+    def test_walk_skips_symlinks(self):
+        """Symbolic links are left alone, so the file they point to is only
+        licensed once."""
+        self.touch("x.py")
+        self.touch("sub/y.py")
+        os.symlink("x.py", os.path.join(self.top, "link.py"))
+        os.symlink("sub", os.path.join(self.top, "linkdir"))
+        self.assertEqual(self.found(), ["sub/y.py", "x.py"])
+
+    def test_walk_bad_top(self):
+        """A top that isn't a directory is an error, not an empty tree."""
+        self.touch("a.py")
+        for top in ["missing", "a.py"]:
+            paths = walker.walk_tree(os.path.join(self.top, top), ["py"])
+            self.assertRaises(objects.RequestError, list, paths)
+
+    def test_split_stream(self):
+        """Records split across chunk boundaries come out whole."""
+        fp = StringIO.StringIO("a.py\0bb/c.c\0d e.py\0")
+        self.assertEqual(list(walker.split_stream(fp, size = 3)),
+                         ["a.py", "bb/c.c", "d e.py"])
+
+    def test_git_changed(self):
+        """Staged and modified files with known suffixes are listed, and
+        deleted ones are not."""
+        def git(*command):
+            walker.git_finish(walker.git(self.top, *command))
+        for relpath in ["a.py", "b.py", "c.txt", "sub/d.c"]:
+            self.touch(relpath)
+        git("init", "-q")
+        git("add", ".")
+        git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "-qm", "x")
+        self.touch("a.py", "changed\n")
+        self.touch("c.txt", "changed\n")
+        self.touch("sub/e.py")
+        git("add", "sub/e.py")
+        git("rm", "-q", "b.py")
+        staged = sorted(walker.git_changed(self.top, ["py", "c"]))
+        self.assertEqual(staged, [os.path.join(os.path.realpath(self.top),
+                                               "sub", "e.py")])
+        changed = walker.git_changed(os.path.join(self.top, "sub"),
+                                     ["py", "c"], "HEAD")
+        self.assertEqual(sorted(os.path.basename(p) for p in changed),
+                         ["a.py", "e.py"])
+
+    def test_walk_exclude_files(self):
+        """Exclude files are anchored at the top of the walk."""
+        for relpath in ["a.py", "sub/a.py", "sub/b.py"]:
+            self.touch(relpath)
+        exclude = os.path.join(self.top, "exclude")
+        with open(exclude, "w") as fp:
+            fp.write("/a.py\nsub/b.py\n")
+        self.assertEqual(self.found(exclude_files = [exclude]), ["sub/a.py"])
+
+class TestApplier(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def write(self, name, text):
+        path = os.path.join(self.top, name)
+        with open(path, "wb") as fp:
+            fp.write(text)
+        return path
+
+    def read(self, path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def test_apply_after_skipped_lines(self):
+        """The box goes in after skip_line lines and no temp file is left
+        behind."""
+        path = self.write("a.py", "#!/bin/sh\necho hi\n")
+        self.assertEqual(applier.apply_license(path, "# box", 1), applier.OK)
+        self.assertEqual(self.read(path), "#!/bin/sh\n# box\necho hi\n")
+        self.assertEqual(os.listdir(self.top), ["a.py"])
+
+    def test_bytes_untouched(self):
+        """Everything after the box is copied exactly, whichever way the
+        copy gets made."""
+        body = "".join(chr(i % 256) for i in range(3 * applier.copy_buffer))
+        text = "#!/bin/sh\r\n" + body + "\r\nno newline"
+        copiers = applier.kernel_copiers
+        try:
+            for kernel_copiers in [copiers, []]:
+                applier.kernel_copiers = kernel_copiers
+                path = self.write("a.sh", text)
+                applier.apply_license(path, "# box", 1)
+                self.assertEqual(self.read(path),
+                                 "#!/bin/sh\r\n# box\n" + body +
+                                 "\r\nno newline")
+        finally:
+            applier.kernel_copiers = copiers
+
+    def test_skip_licensed(self):
+        """A file already carrying the box, even one from another year, is
+        left alone; others get the box."""
+        box = "# (c) 2013 Me  #\n#################"
+        newer = "# (c) 2013-2026 Me #\n#################"
+        print_ = applier.fingerprint(newer)
+        licensed = self.write("a.py", "#!/bin/sh\n%s\necho hi\n" % box)
+        bare = self.write("b.py", "#!/bin/sh\necho hi\n")
+        before = self.read(licensed)
+        self.assertEqual(applier.apply_license(licensed, newer, 1, print_),
+                         applier.SKIPPED)
+        self.assertEqual(self.read(licensed), before)
+        self.assertEqual(applier.apply_license(bare, newer, 1, print_),
+                         applier.OK)
+        self.assertEqual(self.read(bare),
+                         "#!/bin/sh\n%s\necho hi\n" % newer)
+
+    def test_skip_licensed_version(self):
+        """A box for another version of the license isn't taken for the one
+        being applied."""
+        old = "# Version 2.0, (c) 2013 Me #"
+        new = "# Version 3.0, (c) 2026 Me #"
+        path = self.write("a.py", "%s\necho hi\n" % old)
+        self.assertEqual(applier.apply_license(path, new, 0,
+                                               applier.fingerprint(new)),
+                         applier.OK)
+        self.assertEqual(self.read(path), "%s\n%s\necho hi\n" % (new, old))
+
+    def test_read_prefix_long_lines(self):
+        """Skipped lines longer than expected are still skipped."""
+        text = "x" * 1000 + "\n" + "y" * 300 + "\nbox\nrest"
+        fp = StringIO.StringIO(text)
+        self.assertEqual(applier.read_prefix(fp, 2, 3), "box")
+        fp = StringIO.StringIO("short\n")
+        self.assertEqual(applier.read_prefix(fp, 2, 3), "")
+
+    def test_check(self):
+        """Checking reports which files carry the box and writes
+        nothing."""
+        licensed = self.write("a.py", "#!/bin/sh\n# box\necho hi\n")
+        bare = self.write("b.py", "#!/bin/sh\necho hi\n")
+        os.chmod(self.top, 0o555)
+        try:
+            self.assertEqual(applier.check_license(licensed, "# box", 1),
+                             applier.OK)
+            self.assertEqual(applier.check_license(bare, "# box", 1),
+                             applier.MISSING)
+        finally:
+            os.chmod(self.top, 0o755)
+
+    def test_update(self):
+        """An old box is patched in place when the new one is the same
+        length, rewritten around otherwise, and left alone when current."""
+        frame = ("######", "# ", "######")
+        old = "######\n# 2013 #\n# Me   #\n######"
+        path = self.write("a.sh", "#!/bin/sh\n%s\necho hi\n" % old)
+        ino = os.stat(path).st_ino
+        bumped = old.replace("2013", "2026")
+        self.assertEqual(applier.update_license(path, bumped, 1, frame),
+                         applier.OK)
+        self.assertEqual(self.read(path), "#!/bin/sh\n%s\necho hi\n" % bumped)
+        self.assertEqual(os.stat(path).st_ino, ino)
+        os.chmod(path, 0o444)
+        self.assertEqual(applier.update_license(path, bumped, 1, frame),
+                         applier.SKIPPED)
+        os.chmod(path, 0o644)
+        longer = "######\n# 2026 #\n# Me   #\n# You  #\n######"
+        self.assertEqual(applier.update_license(path, longer, 1, frame),
+                         applier.OK)
+        self.assertEqual(self.read(path), "#!/bin/sh\n%s\necho hi\n" % longer)
+        bare = self.write("b.sh", "#!/bin/sh\n# hi\necho hi\n")
+        self.assertEqual(applier.update_license(bare, longer, 1, frame),
+                         applier.MISSING)
+
+    def test_sniff(self):
+        """Binary, generated and oversized files are turned down before
+        anything is written, and the rest still get checked for a box."""
+        cases = [("a.class", "\xca\xfe\xba\xbe\0\0", "binary"),
+                 ("b.go", "// Code generated by x. DO NOT EDIT.\n",
+                  "generated"),
+                 ("c.c", "int x;\n" * 100, "larger than 500 bytes")]
+        for name, text, reason in cases:
+            path = self.write(name, text)
+            self.assertEqual(applier.attempt(applier.apply_license,
+                                             (path, "// box", 0, None, None,
+                                              None, 500)),
+                             ((path, "// box", 0, None, None, None, 500),
+                              applier.EXCLUDED, reason))
+            self.assertEqual(self.read(path), text)
+        self.assertEqual(len(os.listdir(self.top)), 3)
+        path = self.write("d.c", "// box\nint x;\n")
+        print_ = applier.fingerprint("// box")
+        self.assertEqual(applier.apply_license(path, "// box", 0, print_,
+                                               max_size = 500),
+                         applier.SKIPPED)
+        self.assertEqual(applier.check_license(path, "// box", 0,
+                                               max_size = 0),
+                         applier.OK)
+        path = self.write("e.py", "#! /usr/bin/python\nprint 1\n")
+        self.assertEqual(applier.apply_license(path, "# box", 1,
+                                               max_size = 500),
+                         applier.OK)
+        self.assertEqual(self.read(path),
+                         "#! /usr/bin/python\n# box\nprint 1\n")
+
+    def test_filter(self):
+        """Filtering inserts the box just as applying it in place does,
+        and passes licensed or excluded source through unchanged."""
+        source = "#! /usr/bin/python\n" + "print 1\n" * 5000
+        path = self.write("a.py", source)
+        applier.apply_license(path, "# box", 1)
+        fout = StringIO.StringIO()
+        status = applier.filter_license(StringIO.StringIO(source), fout,
+                                        "# box", 1)
+        self.assertEqual(status, applier.OK)
+        self.assertEqual(fout.getvalue(), self.read(path))
+        print_ = applier.fingerprint("# box")
+        fout = StringIO.StringIO()
+        self.assertEqual(applier.filter_license(open(path, "rb"), fout,
+                                                "# box", 1, print_, 0),
+                         applier.SKIPPED)
+        self.assertEqual(fout.getvalue(), self.read(path))
+        path = self.write("b.class", "\xca\xfe\0" * 5000)
+        fout = StringIO.StringIO()
+        self.assertEqual(applier.filter_license(open(path, "rb"), fout,
+                                                "# box", 0, None, 0),
+                         (applier.EXCLUDED, "binary"))
+        self.assertEqual(fout.getvalue(), self.read(path))
+
+    def test_pool_survives_failures(self):
+        """A file that can't be licensed doesn't stop the others."""
+        paths = [self.write("%d.c" % i, "int x;\n") for i in range(20)]
+        paths.insert(7, os.path.join(self.top, "missing.c"))
+        tasks = [(path, "// box", 0) for path in paths]
+        results = list(applier.run_pool(applier.apply_license, tasks, 4))
+        statuses = sorted(status for task, status, detail in results)
+        self.assertEqual(statuses, [applier.ERROR] + [applier.OK] * 20)
+        for path in paths[:7]:
+            self.assertEqual(self.read(path), "// box\nint x;\n")
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.path = os.path.join(self.top, "pycense.journal")
+        self.files = []
+        for i in range(6):
+            self.files.append(os.path.join(self.top, "%d.c" % i))
+            with open(self.files[-1], "wb") as fp:
+                fp.write("int x;\n")
+        self.commit_every = journal.commit_every
+        journal.commit_every = 2
+
+    def tearDown(self):
+        journal.commit_every = self.commit_every
+        shutil.rmtree(self.top)
+
+    def interrupted_run(self):
+        """License 5 of the files under a journal that never finishes."""
+        jrnl = journal.Journal(self.path, {"command": "apply"})
+        for path in self.files[:5]:
+            applier.apply_license(path, "// box", 0, journal = jrnl)
+        jrnl.fp.close()
+        self.assertEqual(len(os.listdir(self.top)), 12)
+
+    def contents(self):
+        result = []
+        for path in self.files:
+            with open(path, "rb") as fp:
+                result.append(fp.read())
+        return result
+
+    def test_rollback(self):
+        """Rolling back restores every file and leaves nothing behind."""
+        self.interrupted_run()
+        self.assertRaises(objects.RequestError, journal.Journal, self.path,
+                          {})
+        self.assertEqual(journal.rollback(self.path), 5)
+        self.assertEqual(self.contents(), ["int x;\n"] * 6)
+        self.assertEqual(sorted(os.listdir(self.top)),
+                         sorted(os.path.basename(f) for f in self.files))
+
+    def test_resume(self):
+        """Only committed files count as done; the rest are put back to be
+        done again, and finishing cleans up."""
+        self.interrupted_run()
+        request, carried = journal.recover(self.path)
+        self.assertEqual(request, {"command": "apply"})
+        done = [record["path"] for record in carried]
+        self.assertEqual(done, self.files[:4])
+        self.assertEqual(self.contents(),
+                         ["// box\nint x;\n"] * 4 + ["int x;\n"] * 2)
+        jrnl = journal.Journal(self.path, request, carried, True)
+        for path in self.files[4:]:
+            applier.apply_license(path, "// box", 0, journal = jrnl)
+        jrnl.finish()
+        self.assertEqual(self.contents(), ["// box\nint x;\n"] * 6)
+        self.assertEqual(len(os.listdir(self.top)), 6)
+
+class TestLibrary(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.dir = os.path.join(self.top, "licenses")
+        self.pack = os.path.join(self.top, "licenses.pack")
+        os.mkdir(self.dir)
+        source = library.Directory(self.dir)
+        source.add("mit", "MIT <year>\n")
+        source.add("bsd", "BSD <owner>\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def test_directory(self):
+        """Without a pack, the directory is the library."""
+        source = library.open_library(self.dir, self.pack)
+        self.assertEqual(source.names(), ["bsd", "mit"])
+        self.assertEqual(source.read("mit"), "MIT <year>\n")
+        self.assertEqual(source.stamp("gpl"), None)
+
+    def test_pack_changes_in_place(self):
+        """Changes to a pack are appended to it rather than rewriting it,
+        and it reads the same when opened again."""
+        library.pack(self.dir, self.pack)
+        source = library.open_library(self.dir, self.pack)
+        self.assertEqual(source.names(), ["bsd", "mit"])
+        ino = os.stat(self.pack).st_ino
+        source.add("gpl", "GPL\n")
+        self.assertTrue(source.rename("bsd", "bsd2"))
+        self.assertFalse(source.remove("bsd"))
+        self.assertTrue(source.remove("mit"))
+        self.assertEqual(os.stat(self.pack).st_ino, ino)
+        source = library.Packed(self.pack)
+        self.assertEqual(source.names(), ["bsd2", "gpl"])
+        self.assertEqual(source.read("bsd2"), "BSD <owner>\n")
+        self.assertEqual(source.file_path("gpl"), None)
+
+    def test_unpack_matches_pack(self):
+        """Unpacking leaves the directory holding just what the pack did,
+        so licenses removed or renamed while packed stay that way."""
+        library.pack(self.dir, self.pack)
+        source = library.open_library(self.dir, self.pack)
+        source.remove("mit")
+        source.rename("bsd", "bsd2")
+        library.unpack(self.pack, self.dir)
+        self.assertFalse(os.path.exists(self.pack))
+        source = library.open_library(self.dir, self.pack)
+        self.assertEqual(source.names(), ["bsd2"])
+        self.assertEqual(source.read("bsd2"), "BSD <owner>\n")
+
+    def test_pack_compacts(self):
+        """Dead space left by replaced licenses is eventually reclaimed."""
+        library.pack(self.dir, self.pack)
+        source = library.Packed(self.pack)
+        for i in range(20):
+            source.add("big", "%d" % (i) * 8192)
+        self.assertTrue(os.path.getsize(self.pack) < 3 * 8192 * 2)
+        self.assertEqual(source.read("big"), "19" * 8192)
+        self.assertEqual(source.read("mit"), "MIT <year>\n")
+
+class TestIdentify(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.source = library.Directory("licenses")
+        self.cache = os.path.join(self.top, "identify.cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def test_boxed_license_found(self):
+        """A license is recognized inside a comment box, whatever the year
+        and owner, and code alone matches nothing."""
+        index = identify.load_index(self.source, self.cache)
+        com = objects.Commentator([("left_wall", ";; "), ("width", 50)])
+        for name in self.source.names():
+            text = objects.Template(self.source.read(name)).render(
+                {"year": "1999", "owner": "Someone Else"})
+            path = os.path.join(self.top, "f.lisp")
+            with open(path, "wb") as fp:
+                fp.write(com.get_boxed(text) + "\n(car x)\n" * 30)
+            status, (found, score) = identify.identify_file(
+                path, index, identify.scan_size(index))
+            self.assertEqual((status, found), (applier.OK, name))
+            self.assertTrue(score > 0.9)
+        self.assertEqual(identify.best_match(index, "(car x)\n" * 30), None)
+
+    def test_index_cached(self):
+        """The index is only rebuilt when the library changes."""
+        built = identify.load_index(self.source, self.cache)
+        build_index = identify.build_index
+        identify.build_index = None
+        try:
+            self.assertEqual(identify.load_index(self.source, self.cache),
+                             built)
+        finally:
+            identify.build_index = build_index
+
+class TestGitFilter(unittest.TestCase):
+    def packets(self, *lists):
+        """Frame lists of packet data as git would, each followed by a
+        flush packet."""
+        out = StringIO.StringIO()
+        for data in lists:
+            for datum in data:
+                gitfilter.write_packet(out, datum)
+            out.write(gitfilter.flush)
+        return out.getvalue()
+
+    def replies(self, text):
+        """Split what the filter wrote into lists of packet data."""
+        fp = StringIO.StringIO(text)
+        lists = []
+        while fp.tell() < len(text):
+            lists.append(gitfilter.read_list(fp))
+        return lists
+
+    def test_clean(self):
+        """The filter shakes hands, cleans what it's asked to, even when it
+        takes more than one packet, and reports failures without going
+        away."""
+        def clean(pathname, source, size, out):
+            if pathname == "bad.py":
+                raise IOError("no")
+            out.write(pathname + ":" + source.read(size))
+        big = "x" * (gitfilter.max_packet + 10)
+        fin = StringIO.StringIO(self.packets(
+            ["git-filter-client\n", "version=2\n"],
+            ["capability=clean\n", "capability=smudge\n"],
+            ["command=clean\n", "pathname=a.py\n"], ["one", "two"],
+            ["command=smudge\n", "pathname=a.py\n"], ["one"],
+            ["command=clean\n", "pathname=bad.py\n"], ["one"],
+            ["command=clean\n", "pathname=big.py\n"], [big]))
+        fout = StringIO.StringIO()
+        log = StringIO.StringIO()
+        gitfilter.serve(fin, fout, clean, log)
+        self.assertEqual(self.replies(fout.getvalue()),
+                         [["git-filter-server", "version=2"],
+                          ["capability=clean"],
+                          ["status=success"], ["a.py:onetwo"], [],
+                          ["status=error"],
+                          ["status=success"], [], ["status=error"],
+                          ["status=success"],
+                          ["big.py:" + big[:gitfilter.max_packet - 7],
+                           big[gitfilter.max_packet - 7:]], []])
+        self.assertEqual(log.getvalue(), "Could not license bad.py: no\n")
+
+    def test_not_git(self):
+        """Anything but git at the other end is turned away."""
+        fin = StringIO.StringIO(self.packets(["hello\n"]))
+        self.assertRaises(objects.RequestError, gitfilter.serve, fin,
+                          StringIO.StringIO(), None)
+
+    def test_hang_up(self):
+        """git hanging up in the middle of the handshake or of a file is an
+        error, rather than the end of the conversation."""
+        handshake = self.packets(["git-filter-client\n", "version=2\n"],
+                                 ["capability=clean\n"])
+        # both cut short at the end of a packet
+        for text in [handshake[:22],
+                     handshake + self.packets(["command=clean\n",
+                                               "pathname=a.py\n"])
+                     + "0007one"]:
+            self.assertRaises(objects.RequestError, gitfilter.serve,
+                              StringIO.StringIO(text), StringIO.StringIO(),
+                              None)
+
+class TestArchive(unittest.TestCase):
+    members = [("pkg/a.py", "print 1\n"), ("pkg/data.bin", "\0" * 4096),
+               ("pkg/big.py", "x" * 100)]
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def clean(self, name, source, size, mtime, out):
+        return applier.filter_license(source, out, "# header\n", 0,
+                                      None, None, size)
+
+    def pick(self, name):
+        return name.endswith(".py")
+
+    def rewrite(self, source, target):
+        return list(archive.rewrite(source, target, self.pick, self.clean,
+                                    max_size = 50))
+
+    def check(self, contents):
+        self.assertEqual(contents, {"pkg/a.py": "# header\n\nprint 1\n",
+                                    "pkg/data.bin": "\0" * 4096,
+                                    "pkg/big.py": "x" * 100})
+
+    def test_tar(self):
+        """Members with known suffixes are licensed, unless they're too
+        large, and the rest come through as they were, compressed however
+        the target asks."""
+        source = os.path.join(self.top, "src.tar.gz")
+        with tarfile.open(source, "w:gz") as tar:
+            for name, data in self.members:
+                info = tarfile.TarInfo(name)
+                info.size, info.mtime, info.mode = len(data), 10 ** 7, 0755
+                tar.addfile(info, StringIO.StringIO(data))
+        target = os.path.join(self.top, "out.tar.bz2")
+        self.assertEqual(self.rewrite(source, target),
+                         [("pkg/a.py", applier.OK, None),
+                          ("pkg/big.py", applier.EXCLUDED,
+                           "larger than 50 bytes")])
+        with tarfile.open(target, "r:bz2") as tar:
+            self.check(dict((info.name, tar.extractfile(info).read())
+                            for info in tar))
+            info = tar.getmember("pkg/a.py")
+            self.assertEqual((info.mtime, info.mode), (10 ** 7, 0755))
+
+    def test_zip(self):
+        """Zip members left alone are copied without being recompressed,
+        and the archive can be rewritten in place."""
+        source = os.path.join(self.top, "src.zip")
+        with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as z:
+            for name, data in self.members:
+                z.writestr(name, data)
+        with zipfile.ZipFile(source) as z:
+            before = z.getinfo("pkg/data.bin")
+        self.assertEqual(len(self.rewrite(source, source)), 2)
+        with zipfile.ZipFile(source) as z:
+            self.assertEqual(z.testzip(), None)
+            self.check(dict((name, z.read(name)) for name in z.namelist()))
+            after = z.getinfo("pkg/data.bin")
+            self.assertEqual((after.compress_size, after.CRC),
+                             (before.compress_size, before.CRC))
+        self.assertEqual(os.listdir(self.top), ["src.zip"])
+
+    def test_zip_streamed(self):
+        """Licensed zip members are compressed a chunk at a time, and come
+        out whole, compressed as they were."""
+        source = os.path.join(self.top, "src.zip")
+        text = "".join("x%d = %d\n" % (i, i) for i in range(1000))
+        with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("a.py", text)
+            z.writestr("b.py", text, zipfile.ZIP_STORED)
+        buffer_size = applier.copy_buffer
+        applier.copy_buffer = 7
+        try:
+            self.assertEqual(len(list(archive.rewrite(source, source,
+                                                      self.pick,
+                                                      self.clean))), 2)
+        finally:
+            applier.copy_buffer = buffer_size
+        with zipfile.ZipFile(source) as z:
+            self.assertEqual(z.testzip(), None)
+            for name, compress_type in [("a.py", zipfile.ZIP_DEFLATED),
+                                        ("b.py", zipfile.ZIP_STORED)]:
+                self.assertEqual(z.read(name), "# header\n\n" + text)
+                self.assertEqual(z.getinfo(name).compress_type,
+                                 compress_type)
+
+    def test_mismatch(self):
+        """Zip archives can't be rewritten as tar archives."""
+        source = os.path.join(self.top, "src.zip")
+        zipfile.ZipFile(source, "w").close()
+        self.assertRaises(objects.RequestError, self.rewrite, source,
+                          os.path.join(self.top, "out.tar"))
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.path = os.path.join(self.top, "config.conf")
+        self.cache = os.path.join(self.top, "config.cache")
+        shutil.copy(os.path.join(os.path.dirname(__file__) or ".",
+                                 "config.conf"), self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def load(self):
+        return configstore.Config(self.path, self.cache)
+
+    def test_cache_matches_file(self):
+        """A configuration loaded from the cache looks just like one parsed
+        from the file."""
+        parsed = self.load()
+        cached = self.load()
+        self.assertTrue(os.path.exists(self.cache))
+        for section in parsed.sections():
+            self.assertEqual(parsed.items(section), cached.items(section))
+        self.assertEqual(parsed.get_profile("c_style"),
+                         cached.get_profile("c_style"))
+
+    def test_cache_invalidated(self):
+        """Changing the configuration file makes the cache stale."""
+        config = self.load()
+        config.set("profiles", "mine", "[('width', 40)]")
+        config.save()
+        self.assertEqual(self.load().get_profile("mine"), [("width", 40)])
+
+    def test_clean_config_not_written(self):
+        """Reading the configuration never writes it."""
+        os.utime(self.path, (0, 0))
+        config = self.load()
+        config.get_profile("c_style")
+        config.remove_option("profiles", "no_such_profile")
+        config.save()
+        self.assertEqual(os.stat(self.path).st_mtime, 0)
+
+    def test_concurrent_changes_kept(self):
+        """Two runs changing different settings at once both get their
+        way, and the file is replaced rather than rewritten in place."""
+        first, second = self.load(), self.load()
+        first.set("defaults", "owner", "First")
+        second.set("suffixes", "xyz", "c_style")
+        second.remove_option("suffixes", "py")
+        ino = os.stat(self.path).st_ino
+        first.save()
+        self.assertNotEqual(os.stat(self.path).st_ino, ino)
+        second.save()
+        config = self.load()
+        self.assertEqual(config.get("defaults", "owner"), "First")
+        self.assertEqual(config.get("suffixes", "xyz"), "c_style")
+        self.assertFalse(config.has_option("suffixes", "py"))
+
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.saved = pycense.config_file, pycense.cache_file
+        pycense.config_file = os.path.join(self.top, "config.conf")
+        pycense.cache_file = os.path.join(self.top, "config.cache")
+        shutil.copy(os.path.join(os.path.dirname(__file__) or ".",
+                                 "config.conf"), pycense.config_file)
+        pycense.config = None
+        self.path = os.path.join(self.top, "a.py")
+        with open(self.path, "w") as fp:
+            fp.write("#! /usr/bin/python\nprint 1\n")
+
+    def tearDown(self):
+        pycense.config_file, pycense.cache_file = self.saved
+        pycense.config = None
+        shutil.rmtree(self.top)
+
+    def test_import_quiet(self):
+        """Importing pycense doesn't read the configuration file."""
+        saved = sys.modules.pop("pycense")
+        try:
+            fresh = __import__("pycense")
+            self.assertTrue(fresh.config is None)
+        finally:
+            sys.modules["pycense"] = saved
+
+    def test_apply_and_check(self):
+        """Files are checked and licensed in process, with a Result for
+        each, and the configuration file is never written."""
+        os.utime(pycense.config_file, (0, 0))
+        missing = pycense.check_many([self.path], values = [("owner", "Me")])
+        self.assertEqual(missing, [(self.path, applier.MISSING, None)])
+        applied = pycense.apply_many([self.path], values = [("owner", "Me")])
+        self.assertEqual(applied[0].status, applier.OK)
+        header = pycense.render_header(path = self.path,
+                                       values = [("owner", "Me")])
+        with open(self.path) as fp:
+            self.assertEqual(fp.read(),
+                             "#! /usr/bin/python\n" + header + "\nprint 1\n")
+        present = pycense.check_many([self.path], values = [("owner", "Me")])
+        self.assertEqual(present[0].status, applier.OK)
+        self.assertEqual(os.stat(pycense.config_file).st_mtime, 0)
+
+    def test_profiles_by_suffix(self):
+        """Files whose suffixes map to different profiles each get their own
+        profile's box in a single run."""
+        other = os.path.join(self.top, "b.c")
+        with open(other, "w") as fp:
+            fp.write("int x;\n")
+        results = pycense.apply_many([self.path, other])
+        self.assertEqual([result.status for result in results],
+                         [applier.OK] * 2)
+        py_box = pycense.render_header(path = self.path)
+        c_box = pycense.render_header(path = other)
+        self.assertNotEqual(py_box, c_box)
+        self.assertTrue(c_box.startswith("/"))
+        with open(self.path) as fp:
+            self.assertEqual(fp.read(),
+                             "#! /usr/bin/python\n" + py_box + "\nprint 1\n")
+        with open(other) as fp:
+            self.assertEqual(fp.read(), c_box + "\nint x;\n")
+
+    def test_file_fields(self):
+        """Fields filled in for each file get each file's own values."""
+        lib = os.path.join(self.top, "licenses")
+        os.mkdir(lib)
+        with open(os.path.join(lib, "mine.txt"), "w") as fp:
+            fp.write("Copyright <year> <owner>\n\nThis is <path>, or "
+                     "<module>.\n")
+        saved = pycense.license_dir, pycense.pack_file
+        pycense.license_dir = lib
+        pycense.pack_file = os.path.join(self.top, "licenses.pack")
+        pycense.lib = None
+        try:
+            os.mkdir(os.path.join(self.top, "pkg"))
+            other = os.path.join(self.top, "pkg", "b.py")
+            shutil.copy(self.path, other)
+            os.utime(other, (10 ** 7, 10 ** 7))
+            cwd = os.getcwd()
+            os.chdir(self.top)
+            try:
+                results = pycense.apply_many([self.path, other],
+                                             license = "mine",
+                                             file_year = True)
+            finally:
+                os.chdir(cwd)
+            self.assertEqual([result.status for result in results],
+                             [applier.OK] * 2)
+            with open(other) as fp:
+                text = fp.read()
+            self.assertTrue("This is pkg/b.py, or pkg.b." in text)
+            self.assertTrue("Copyright 1970 " in text)
+            with open(self.path) as fp:
+                self.assertTrue("This is a.py, or a." in fp.read())
+        finally:
+            pycense.license_dir, pycense.pack_file = saved
+            pycense.lib = None
+
+    def test_paths_from(self):
+        """Paths can be streamed in from a file, separated by NULs, and
+        those with unknown suffixes are left out."""
+        other = os.path.join(self.top, "b c.txt")
+        shutil.copy(self.path, other)
+        listing = os.path.join(self.top, "listing")
+        with open(listing, "w") as fp:
+            fp.write("%s\0%s\0" % (self.path, other))
+        results = pycense.apply_many([], paths_from = listing, null = True)
+        self.assertEqual(results, [(self.path, applier.OK, None)])
+
+    def test_caches_cleared(self):
+        """Boxes are still returned when the caches are cleared, as by a
+        daemon reloading its configuration, as soon as they're stored."""
+        class Forgetful(dict):
+            def __setitem__(self, key, value):
+                pass
+        saved = pycense.renderers, pycense.boxes, pycense.headers
+        pycense.renderers = pycense.boxes = pycense.headers = Forgetful()
+        try:
+            pycense.ensure_config()
+            boxed = pycense.get_box("basic_scripting", [], "text")[0]
+            self.assertTrue("text" in boxed)
+            template = objects.Template("<path>")
+            header = pycense.get_header("basic_scripting", [], template)[0]
+            self.assertTrue("a.py" in header.render({"path": "a.py"}))
+        finally:
+            pycense.renderers, pycense.boxes, pycense.headers = saved
+
+    def test_errors_raised(self):
+        """Bad requests raise RequestError rather than exiting."""
+        self.assertRaises(objects.RequestError, pycense.apply_many,
+                          [self.path], license = "no_such_license")
+        self.assertRaises(objects.RequestError, pycense.load_profile,
+                          "no_such_profile")
+        self.assertRaises(TypeError, pycense.apply_many, [self.path],
+                          no_such_option = 1)
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.path = os.path.join(self.top, "pycense.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+
+    def work(self, request):
+        if request["command"] == "fail":
+            raise objects.RequestError("no can do")
+        for path in request["paths"]:
+            yield path, "ok", None
+
+    def test_no_daemon(self):
+        """With nobody listening, clients are told to do the work
+        themselves."""
+        self.assertEqual(daemon.connect(self.path), None)
+
+    def test_exchange(self):
+        """Results and errors make it back to the client."""
+        server = daemon.Server(self.path, self.work)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.start()
+        try:
+            request = {"command": "apply", "paths": ["a.py", "b.c"]}
+            results = daemon.exchange(daemon.connect(self.path), request)
+            self.assertEqual(list(results),
+                             [("a.py", "ok", None), ("b.c", "ok", None)])
+            results = daemon.exchange(daemon.connect(self.path),
+                                      {"command": "fail"})
+            self.assertRaises(objects.RequestError, list, results)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+class TestTiming(unittest.TestCase):
+    class Clock:
+        """Stands in for time.time and cpu_time, moving only when told
+        to."""
+        now = 0.0
+        def time(self):
+            return self.now
+
+    def setUp(self):
+        self.clock = self.Clock()
+        self.saved = timing.time, timing.cpu_time
+        timing.time, timing.cpu_time = self.clock, self.clock.time
+
+    def tearDown(self):
+        timing.time, timing.cpu_time = self.saved
+
+    def test_nested_phases(self):
+        """Time spent in an inner phase isn't charged to the outer one."""
+        stats = timing.Stats()
+        with stats.phase("outer"):
+            self.clock.now += 2
+            with stats.phase("inner"):
+                self.clock.now += 5
+            self.clock.now += 2
+        phases = dict((p["phase"], (p["wall"], p["cpu"]))
+                      for p in stats.report()["phases"])
+        self.assertEqual(phases, {"outer": (4, 4), "inner": (5, 5)})
+
+    def test_counters(self):
+        """Counters add up across threads."""
+        stats = timing.Stats()
+        def bump():
+            for i in range(1000):
+                stats.count("files_ok")
+        threads = [threading.Thread(target = bump) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stats.report()["counters"], {"files_ok": 4000})
+
+    def test_concurrent_phases(self):
+        """Threads entering phases at once each nest their own, as the
+        daemon's and library callers' threads do, so one thread leaving a
+        phase doesn't end another's."""
+        stats = timing.Stats()
+        def work(name, entered, leave):
+            with stats.phase(name):
+                entered.set()
+                leave.wait()
+        events = dict((name, (threading.Event(), threading.Event()))
+                      for name in ["a", "b"])
+        threads = dict((name, threading.Thread(target = work,
+                                               args = (name,) + pair))
+                       for name, pair in events.items())
+        for name in ["a", "b"]:
+            threads[name].start()
+            events[name][0].wait()
+        for name, now in [("a", 3), ("b", 5)]:
+            self.clock.now = now
+            events[name][1].set()
+            threads[name].join()
+        phases = dict((p["phase"], p["wall"])
+                      for p in stats.report()["phases"])
+        self.assertEqual(phases, {"a": 3, "b": 5})
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,269 @@
+#! /usr/bin/python
+###############################################################################
+# Copyright (c) 2013 Charlie Pashayan                                         #
+#                                                                             #
+# Permission is hereby granted, free of charge, to any person obtaining a     #
+# copy of this software and associated documentation files (the "Software"),  #
+# to deal in the Software without restriction, including without limitation   #
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,    #
+# and/or sell copies of the Software, and to permit persons to whom the       #
+# Software is furnished to do so, subject to the following conditions:        #
+#                                                                             #
+# The above copyright notice and this permission notice shall be included in  #
+# all copies or substantial portions of the Software.                         #
+#                                                                             #
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR  #
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,    #
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE #
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER      #
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING     #
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER         #
+# DEALINGS IN THE SOFTWARE.                                                   #
+###############################################################################
+
+
+import os
+import re
+import stat
+import subprocess
+
+import objects as obj
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# directories holding other people's code; never descended into
+vendored_dirs = [".git", ".hg", ".svn", ".bzr", "CVS", "node_modules",
+                 "bower_components", "vendor", "third_party", "site-packages",
+                 "__pycache__", ".tox", ".venv", "venv"]
+ignore_name = ".gitignore"
+
+class _Entry:
+    """Stand-in for os.DirEntry when no scandir implementation is
+    available."""
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def _mode(self, follow_symlinks):
+        try:
+            if follow_symlinks:
+                return os.stat(self.path).st_mode
+            return os.lstat(self.path).st_mode
+        except OSError:
+            return 0
+
+    def is_dir(self, follow_symlinks = True):
+        return stat.S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks = True):
+        return stat.S_ISREG(self._mode(follow_symlinks))
+
+def list_entries(dirpath):
+    """Generate directory entries for dirpath, using scandir when possible."""
+    if scandir:
+        for entry in scandir(dirpath):
+            yield entry
+    else:
+        for name in os.listdir(dirpath):
+            yield _Entry(dirpath, name)
+
+def translate(pattern):
+    """Turn the body of a gitignore-style glob into a regular expression
+    matching slash-separated relative paths."""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+        elif c == "*":
+            res.append("[^/]*")
+            i += 1
+        elif c == "?":
+            res.append("[^/]")
+            i += 1
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j == -1:
+                res.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:j]
+                if body[0] == "!":
+                    body = "^" + body[1:]
+                res.append("[%s]" % (body.replace("\\", "\\\\")))
+                i = j + 1
+        elif c == "\\" and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return "".join(res) + "$"
+
+class IgnoreRules:
+    """Patterns read from one gitignore-style file.
+
+    base: path of the directory holding the file, relative to the top of
+      the walk; anchored patterns are matched relative to it."""
+
+    def __init__(self, lines, base = ""):
+        self.base = base
+        self.patterns = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            line = line.rstrip(" ")
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith("\\"):
+                # escaped leading ! or #
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line:
+                continue
+            self.patterns.append((re.compile(translate(line)), negate,
+                                  dir_only, anchored))
+
+    def match(self, relpath, is_dir):
+        """Decide whether relpath is ignored by these rules.  Returns True
+        or False if some pattern has an opinion, else None."""
+        if self.base:
+            if not relpath.startswith(self.base + "/"):
+                return None
+            relpath = relpath[len(self.base) + 1:]
+        name = relpath.rsplit("/", 1)[-1]
+        verdict = None
+        for regex, negate, dir_only, anchored in self.patterns:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath if anchored else name):
+                verdict = not negate
+        return verdict
+
+def read_rules(path, base = ""):
+    """Load the gitignore-style file at path, or return None if there isn't
+    one."""
+    try:
+        with open(path, "r") as fp:
+            return IgnoreRules(fp, base)
+    except IOError:
+        return None
+
+def is_ignored(rules, relpath, is_dir):
+    """The last rule set with an opinion wins, deeper files overriding
+    shallower ones."""
+    ignored = False
+    for r in rules:
+        verdict = r.match(relpath, is_dir)
+        if verdict is not None:
+            ignored = verdict
+    return ignored
+
+def walk_tree(top, suffixes, prune = vendored_dirs, exclude_files = []):
+    """Generate the paths of files beneath top whose suffixes appear in
+    suffixes, as they are found.  Directories named in prune or ignored by
+    the exclude files or by any .gitignore found along the way are never
+    entered, and symbolic links are never followed.
+
+    top: directory to search.
+    suffixes: collection of file extensions, without periods.
+    prune: names of directories to skip wherever they appear.
+    exclude_files: gitignore-style files whose patterns are anchored at
+      top.
+    Raises objects.RequestError if top itself can't be searched."""
+    rules = [r for r in [read_rules(path) for path in exclude_files] if r]
+    pending = [(top, "", rules)]
+    while pending:
+        dirpath, relpath, rules = pending.pop()
+        local = read_rules(os.path.join(dirpath, ignore_name), relpath)
+        if local:
+            rules = rules + [local]
+        try:
+            entries = list_entries(dirpath)
+            subdirs = []
+            for entry in entries:
+                rel = relpath + "/" + entry.name if relpath else entry.name
+                if entry.is_dir(follow_symlinks = False):
+                    if (entry.name not in prune and
+                        not is_ignored(rules, rel, True)):
+                        subdirs.append((entry.path, rel, rules))
+                elif entry.is_file(follow_symlinks = False):
+                    suffix = os.path.splitext(entry.name)[1][1:]
+                    if (suffix in suffixes and
+                        not is_ignored(rules, rel, False)):
+                        yield entry.path
+        except OSError as err:
+            if dirpath == top:
+                raise obj.RequestError("Cannot search %s: %s"
+                                       % (top, err.strerror or err))
+            # unreadable directory; nothing to license in there
+            continue
+        # descend in the order the directories were listed
+        pending.extend(reversed(subdirs))
+
+def split_stream(fp, delimiter = "\0", size = 1 << 16):
+    """Generate the delimited records read from a file object a chunk at a
+    time, without holding more than one chunk and one record."""
+    partial = ""
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        records = (partial + chunk).split(delimiter)
+        partial = records.pop()
+        for record in records:
+            yield record
+    if partial:
+        yield partial
+
+def git(cwd, *command):
+    """Start a git command in cwd, with its output on a pipe."""
+    try:
+        return subprocess.Popen(("git",) + command, cwd = cwd,
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+    except OSError as err:
+        raise obj.RequestError("Cannot run git: %s" % (err))
+
+def git_finish(proc):
+    """Wait for a git command, complaining if it failed."""
+    err = proc.stderr.read()
+    if proc.wait():
+        raise obj.RequestError("git failed: %s" % (err.strip()))
+
+def git_changed(cwd, suffixes, rev = None):
+    """Generate the absolute paths of files with suffixes listed in
+    suffixes that have been added, copied, modified or renamed, as reported
+    by a single git diff.  Deleted files are left out.
+
+    cwd: directory inside the repository.
+    rev: compare the working tree against this revision; if None, list
+      the changes staged for the next commit instead."""
+    proc = git(cwd, "rev-parse", "--show-toplevel")
+    top = proc.stdout.read().rstrip("\n")
+    git_finish(proc)
+    command = ["diff", "--name-only", "-z", "--diff-filter=ACMR"]
+    command += [rev, "--"] if rev else ["--cached"]
+    proc = git(cwd, *command)
+    for relpath in split_stream(proc.stdout):
+        suffix = os.path.splitext(relpath)[1][1:]
+        if suffix in suffixes:
+            yield os.path.join(top, relpath)
+    git_finish(proc)